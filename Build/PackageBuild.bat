@@ -18,6 +18,7 @@ mkdir "FlowframesApp%ver%/FlowframesData"
 mkdir "FlowframesApp%ver%/FlowframesData/pkgs"
 
 rem xcopy "../../../../pkgs" "FlowframesApp%ver%/FlowframesData\pkgs\" /E
+xcopy "../../../../pkgs/common" "FlowframesApp%ver%/FlowframesData\pkgs\common" /E /I
 xcopy "../../../../pkgs/av" "FlowframesApp%ver%/FlowframesData\pkgs\av" /E /I
 xcopy "../../../../pkgs/dain-ncnn" "FlowframesApp%ver%/FlowframesData\pkgs\dain-ncnn" /E /I
 xcopy "../../../../pkgs/licenses" "FlowframesApp%ver%/FlowframesData\pkgs\licenses" /E /I
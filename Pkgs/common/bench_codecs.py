@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+
+# Encode/decode throughput of the intermediate frame codecs against PNG levels 0-9.
+# MB/s is measured on uncompressed pixel bytes, so the numbers are comparable across codecs.
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from ffcommon import framecodecs
+
+parser = argparse.ArgumentParser(description='Benchmark intermediate frame codecs')
+parser.add_argument('--input', default=None, help='Frame dir, synthetic frames if omitted')
+parser.add_argument('--frames', type=int, default=8)
+parser.add_argument('--size', type=int, nargs=2, default=[1080, 1920], help='H W of synthetic frames')
+parser.add_argument('--repeat', type=int, default=2)
+args = parser.parse_args()
+
+def load_frames():
+    if args.input is not None:
+        files = sorted(f for f in os.listdir(args.input) if os.path.splitext(f)[1][1:].lower() in ('png', 'jpg', 'bmp', 'tiff'))
+        return [cv2.imread(os.path.join(args.input, f), cv2.IMREAD_UNCHANGED) for f in files[:args.frames]]
+    # Smooth gradients plus noise and a flat region, roughly what rendered/filmed content compresses like
+    h, w = args.size
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:h, 0:w]
+    frames = []
+    for i in range(args.frames):
+        base = np.stack(((x + i * 4) % 256, (y + x // 2) % 256, (y * 2 + i) % 256), axis=2).astype(np.int16)
+        img = np.clip(base + rng.integers(-3, 4, base.shape), 0, 255).astype(np.uint8)
+        img[h // 3:h // 2, w // 4:w // 2] = 40
+        frames.append(img)
+    return frames
+
+def measure(fmt, level, frames):
+    mb = sum(f.nbytes for f in frames) / 1e6
+    enc_best = dec_best = float('inf')
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        encoded = [framecodecs.encode(f, fmt, level) for f in frames]
+        enc_best = min(enc_best, time.perf_counter() - start)
+        encoded = [bytes(e) for e in encoded]
+        start = time.perf_counter()
+        for e in encoded:
+            framecodecs.decode(e)
+        dec_best = min(dec_best, time.perf_counter() - start)
+    size = sum(len(e) for e in encoded) / 1e6
+    return mb / enc_best, mb / dec_best, size / mb
+
+frames = load_frames()
+print(f"{len(frames)} frames of {frames[0].shape}, {sum(f.nbytes for f in frames) / 1e6:.1f} MB uncompressed")
+print(f"{'format':>8} {'enc MB/s':>10} {'dec MB/s':>10} {'ratio':>7}")
+cases = [(fmt, 0) for fmt in framecodecs.available()] + [('png', level) for level in range(10)]
+for fmt, level in cases:
+    enc, dec, ratio = measure(fmt, level, frames)
+    name = f"png{level}" if fmt == 'png' else fmt
+    print(f"{name:>8} {enc:10.1f} {dec:10.1f} {ratio:7.3f}")
@@ -0,0 +1,2 @@
+# Shared helpers for the Python interpolation runners (rife-cuda, flavr-cuda, xvfi-cuda).
+# Runners add Pkgs/common to sys.path; Pkgs itself must not be added as Pkgs/av would shadow PyAV.
@@ -0,0 +1,113 @@
+import os
+import sys
+import threading
+from collections import deque
+import numpy as np
+
+# Byte-bounded queues so read/write buffers scale with frame size instead of a fixed frame count.
+
+def item_bytes(item):
+    # Counts the numpy arrays and tensors (frames) in an item, nested lists/tuples included; paths count as their length
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    if hasattr(item, 'element_size') and hasattr(item, 'nelement'):
+        return item.element_size() * item.nelement()
+    if isinstance(item, (list, tuple)):
+        return sum(item_bytes(x) for x in item)
+    if isinstance(item, (str, bytes)):
+        return len(item)
+    return 0
+
+def available_memory():
+    # Available physical memory in bytes, or None if it can't be determined
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong), ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong), ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong), ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def memory_budget(mem_budget_mb=None, fraction=0.5, fallback_mb=4096):
+    # Explicit --mem-budget in MB, otherwise a fraction of the currently available RAM
+    if mem_budget_mb:
+        return int(mem_budget_mb * 1024 ** 2)
+    available = available_memory()
+    return int(available * fraction) if available else fallback_mb * 1024 ** 2
+
+class Cancelled(Exception):
+    pass
+
+class ByteQueue:
+    # Queue.Queue-like FIFO bounded by the total size of queued items (see item_bytes) and optionally a count.
+    # A single item larger than the budget is still accepted when the queue is empty, so producers never deadlock.
+    # cancel() wakes every blocked put/get and makes them raise Cancelled.
+    def __init__(self, max_bytes, max_items=0, name='queue'):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.name = name
+        self.items = deque()
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.peak_items = 0
+        self.cancelled = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        size = item_bytes(item)
+        with self.cond:
+            while not self.cancelled and self.qsize() > 0 and (self.bytes + size > self.max_bytes or (self.max_items and self.qsize() >= self.max_items)):
+                self.cond.wait()
+            if self.cancelled:
+                raise Cancelled(self.name)
+            self.items.append((item, size))
+            self.bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.bytes)
+            self.peak_items = max(self.peak_items, self.qsize())
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while not self.cancelled and self.qsize() == 0:
+                self.cond.wait()
+            if self.cancelled:
+                raise Cancelled(self.name)
+            item, size = self.items.popleft()
+            self.bytes -= size
+            self.cond.notify_all()
+            return item
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def fill(self):
+        # Fraction of the byte budget (or count cap, whichever is fuller) in use
+        with self.cond:
+            count_fill = self.qsize() / self.max_items if self.max_items else 0
+            return max(self.bytes / max(self.max_bytes, 1), count_fill)
+
+    def stats(self):
+        return f"{self.name}: peak {self.peak_bytes / 1024 ** 2:.1f} of {self.max_bytes / 1024 ** 2:.1f} MB ({self.peak_items} items)"
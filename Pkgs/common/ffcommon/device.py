@@ -0,0 +1,60 @@
+import os
+import contextlib
+import torch
+
+# Device selection for the runners: CUDA when available, otherwise a CPU path set up for inference
+# (intra-op threads on physical cores, channels-last weights, optional bf16 autocast).
+
+def physical_cores():
+    try:
+        import psutil
+        cores = psutil.cpu_count(logical=False)
+        if cores:
+            return cores
+    except ImportError:
+        pass
+    return os.cpu_count() or 1
+
+def select(name='auto'):
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if name == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError("CUDA was requested but is not available")
+    return torch.device(name)
+
+def configure_cpu(threads=0):
+    # Hyper-threads share the vector units, so one intra-op thread per physical core is usually fastest
+    threads = threads or physical_cores()
+    torch.set_num_threads(threads)
+    return threads
+
+def bf16_supported():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def bf16_autocast_available():
+    # torch.autocast, the device-generic API with CPU support, only exists from torch 1.10
+    return hasattr(torch, 'autocast')
+
+def channels_last(model):
+    # Conv weights to channels-last (3D convs: channels_last_3d), which the oneDNN CPU kernels run natively.
+    # Done per parameter as module.to(memory_format=...) rejects models mixing 4-D and 5-D weights
+    for p in model.parameters():
+        if p.dim() == 5:
+            p.data = p.data.contiguous(memory_format=torch.channels_last_3d)
+        elif p.dim() == 4:
+            p.data = p.data.contiguous(memory_format=torch.channels_last)
+    return model
+
+def autocast(device, bf16=False):
+    if device.type == 'cpu' and bf16:
+        if not bf16_autocast_available():
+            raise RuntimeError("bfloat16 autocast on CPU needs torch 1.10 or newer, this is torch " + torch.__version__)
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def load(path, device):
+    # Checkpoints saved on a GPU load on any host
+    return torch.load(path, map_location=device)
@@ -0,0 +1,158 @@
+import os
+import struct
+import numpy as np
+import cv2
+
+# Fast lossless codecs for intermediate frames, which are read once by the encoder and deleted.
+# Format names double as file extensions so the runners' '{:0>8d}.{}'.format(n, fmt) naming keeps working.
+# Any other format name (png, jpg, tiff...) goes through OpenCV as before.
+#
+#   raw  - header + uncompressed pixels
+#   lz4  - header + LZ4 frame of the pixel array (needs the lz4 package)
+#   zst  - header + zstd frame of the pixel array (needs the zstandard package)
+#   qoiv - header + QOI-style op stream (previous-pixel diff, runs, 1/2/3 byte ops), vectorized with numpy
+#
+# All arrays are HxW or HxWxC, uint8 or uint16, in OpenCV (BGR) channel order.
+
+MAGIC = b'FFRM'
+HEADER = struct.Struct('<4sBBBBII')  # magic, codec, dtype, channels, reserved, height, width
+CODEC_IDS = {'raw': 0, 'lz4': 1, 'zst': 2, 'qoiv': 3}
+DTYPES = [np.uint8, np.uint16]
+QOIV_STREAMS = struct.Struct('<6I')  # ops, tag bytes, run bytes, diff bytes, luma bytes, rgb bytes
+OP_RUN, OP_DIFF, OP_LUMA, OP_RGB = range(4)
+
+def is_codec(fmt):
+    return fmt.lower() in CODEC_IDS
+
+def _lz4():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError("Frame format 'lz4' needs the lz4 package (pip install lz4)")
+    return lz4.frame
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Frame format 'zst' needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+def available():
+    names = ['raw', 'qoiv']
+    for name, check in (('lz4', _lz4), ('zst', _zstd)):
+        try:
+            check()
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+def _qoiv_encode(img):
+    # Planar uint8 math throughout: diffs wrap mod 256 and decoding sums mod 256, so range tests on the
+    # wrapped values (x + bias < limit) are exact and no signed widening is needed
+    b, g, r = np.ascontiguousarray(img.reshape(-1, 3).T)
+    n = len(b)
+    planes = []
+    for p in (b, g, r):
+        d = p.copy()
+        d[1:] -= p[:-1]  # First pixel is diffed against black like QOI
+        planes.append(d)
+    db, dg, dr = planes
+    zero = (db | dg | dr) == 0
+    small = ~zero & (((db + 2) | (dg + 2) | (dr + 2)) < 4)
+    dbg, drg = db - dg + 8, dr - dg + 8
+    luma = ~zero & ~small & ((dg + 32) < 64) & ((dbg | drg) < 16)
+    cls = np.full(n, OP_RGB, np.uint8)
+    cls[luma], cls[small], cls[zero] = OP_LUMA, OP_DIFF, OP_RUN
+
+    # Every non-zero pixel starts an op, zero pixels start one at the beginning of each 256 pixel run chunk
+    idx = np.arange(n, dtype=np.int64)
+    run_start = zero.copy()
+    run_start[1:] &= ~zero[:-1]
+    pos_in_run = idx - np.maximum.accumulate(np.where(run_start, idx, 0))
+    op_pos = np.flatnonzero(~zero | ((pos_in_run & 255) == 0))
+    ops = cls[op_pos]
+    lengths = np.diff(np.append(op_pos, n))
+
+    runs = (lengths[ops == OP_RUN] - 1).astype(np.uint8)
+    diffs = ((np.compress(small, db) + 2) << 4) | ((np.compress(small, dg) + 2) << 2) | (np.compress(small, dr) + 2)
+    lumas = np.empty((np.count_nonzero(luma), 2), np.uint8)
+    lumas[:, 0] = np.compress(luma, dg) + 32
+    lumas[:, 1] = (np.compress(luma, dbg) << 4) | np.compress(luma, drg)
+    rgb = cls == OP_RGB
+    rgbs = np.empty((np.count_nonzero(rgb), 3), np.uint8)
+    for c, d in enumerate((db, dg, dr)):
+        rgbs[:, c] = np.compress(rgb, d)
+    tags = np.zeros(-(-len(ops) // 4) * 4, np.uint8)
+    tags[:len(ops)] = ops
+    tags = tags.reshape(-1, 4)
+    tags = (tags[:, 0] << 6) | (tags[:, 1] << 4) | (tags[:, 2] << 2) | tags[:, 3]
+    streams = [tags, runs, diffs, lumas, rgbs]
+    return QOIV_STREAMS.pack(len(ops), *[s.size for s in streams]) + b''.join(s.tobytes() for s in streams)
+
+def _qoiv_decode(payload, h, w):
+    n_ops, *sizes = QOIV_STREAMS.unpack_from(payload)
+    buf = np.frombuffer(payload, np.uint8, offset=QOIV_STREAMS.size)
+    tags, runs, diffs, lumas, rgbs = np.split(buf, np.cumsum(sizes)[:-1])
+    ops = np.stack((tags >> 6, (tags >> 4) & 3, (tags >> 2) & 3, tags & 3), axis=1).reshape(-1)[:n_ops]
+
+    counts = np.ones(n_ops, np.int64)
+    counts[ops == OP_RUN] = runs.astype(np.int64) + 1
+    # Gather each op's diff from a table of [zero row (runs), diff ops, luma ops, rgb ops] in one pass
+    lumas, rgbs = lumas.reshape(-1, 2), rgbs.reshape(-1, 3)
+    table = np.zeros((1 + len(diffs) + len(lumas) + len(rgbs), 3), np.uint8)
+    table[1:1 + len(diffs)] = np.stack(((diffs >> 4) & 3, (diffs >> 2) & 3, diffs & 3), axis=1) - 2
+    dg = lumas[:, 0] - 32
+    table[1 + len(diffs):1 + len(diffs) + len(lumas)] = np.stack(((lumas[:, 1] >> 4) - 8 + dg, dg, (lumas[:, 1] & 15) - 8 + dg), axis=1)
+    table[1 + len(diffs) + len(lumas):] = rgbs
+    sel = np.zeros(n_ops, np.int64)
+    offset = 1
+    for op in (OP_DIFF, OP_LUMA, OP_RGB):
+        mask = ops == op
+        sel[mask] = np.arange(offset, offset + np.count_nonzero(mask))
+        offset += np.count_nonzero(mask)
+    out = np.cumsum(np.repeat(table[sel], counts, axis=0), axis=0, dtype=np.uint8)
+    return out.reshape(h, w, 3)
+
+def encode(img, fmt, png_level=None):
+    # Returns the encoded file contents (bytes or a uint8 array, both can be written with .tofile/.write)
+    fmt = fmt.lower()
+    if not is_codec(fmt):
+        return cv2.imencode('.' + fmt, img, [] if png_level is None else [cv2.IMWRITE_PNG_COMPRESSION, png_level])[1]
+    img = np.ascontiguousarray(img)
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    if fmt == 'qoiv' and (img.dtype != np.uint8 or channels != 3):
+        fmt = 'raw'  # The op set is defined for 8-bit 3 channel pixels only
+    header = HEADER.pack(MAGIC, CODEC_IDS[fmt], DTYPES.index(img.dtype.type), channels, 0, img.shape[0], img.shape[1])
+    if fmt == 'raw':
+        return header + img.tobytes()
+    if fmt == 'lz4':
+        return header + _lz4().compress(img.tobytes(), compression_level=0, store_size=True)
+    if fmt == 'zst':
+        return header + _zstd().ZstdCompressor(level=1).compress(img.tobytes())
+    return header + _qoiv_encode(img)
+
+def decode(data):
+    if data[:4] != MAGIC:
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    _, codec, dtype, channels, _, h, w = HEADER.unpack_from(data)
+    payload = memoryview(data)[HEADER.size:]
+    shape = (h, w) if channels == 1 else (h, w, channels)
+    if codec == CODEC_IDS['qoiv']:
+        return _qoiv_decode(payload, h, w)
+    if codec == CODEC_IDS['lz4']:
+        payload = _lz4().decompress(payload)
+    elif codec == CODEC_IDS['zst']:
+        payload = _zstd().ZstdDecompressor().decompress(payload)
+    return np.frombuffer(payload, DTYPES[dtype]).reshape(shape)
+
+def write(path, img, png_level=None):
+    fmt = os.path.splitext(path)[1][1:]
+    data = encode(img, fmt, png_level)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read(path):
+    with open(path, 'rb') as f:
+        return decode(f.read())
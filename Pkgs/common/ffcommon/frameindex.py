@@ -0,0 +1,58 @@
+import os
+import array
+import numpy as np
+from .framecodecs import CODEC_IDS
+
+# Index of numbered frames ("00000001.png") in a directory, built with one os.scandir pass and kept as numpy
+# arrays (~10 bytes per frame) instead of lists of path strings. Names must be <digits>.<ext>, anything else is
+# skipped; paths are rebuilt on demand so iterating a million frames never materializes a million strings.
+
+IMAGE_EXTS = ('png', 'jpg', 'jpeg', 'bmp', 'tif', 'tiff', 'webp') + tuple(CODEC_IDS)
+
+class FrameIndex:
+    def __init__(self, directory, exts=IMAGE_EXTS):
+        self.directory = directory
+        self.exts = []
+        ext_ids = {}
+        allowed = {e.lower() for e in exts}
+        numbers, widths, ext_codes = array.array('q'), array.array('B'), array.array('B')
+        self.skipped = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                stem, dot, ext = entry.name.rpartition('.')
+                if not dot or not stem.isascii() or not stem.isdigit() or ext.lower() not in allowed or not entry.is_file():
+                    self.skipped += 1
+                    continue
+                if ext not in ext_ids:
+                    ext_ids[ext] = len(self.exts)
+                    self.exts.append(ext)
+                numbers.append(int(stem))
+                widths.append(len(stem))
+                ext_codes.append(ext_ids[ext])
+        numbers = np.frombuffer(numbers, np.int64) if numbers else np.zeros(0, np.int64)
+        order = np.argsort(numbers, kind='stable')
+        self.numbers = numbers[order]
+        self.widths = np.frombuffer(widths, np.uint8)[order] if widths else np.zeros(0, np.uint8)
+        self.ext_codes = np.frombuffer(ext_codes, np.uint8)[order] if ext_codes else np.zeros(0, np.uint8)
+        dupes = np.flatnonzero(np.diff(self.numbers) == 0)
+        if len(dupes):
+            raise ValueError(f"Frame number {self.numbers[dupes[0]]} appears more than once in {directory}")
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def name(self, i):
+        return f"{self.numbers[i]:0{self.widths[i]}d}.{self.exts[self.ext_codes[i]]}"
+
+    def path(self, i):
+        return os.path.join(self.directory, self.name(i))
+
+    def ext(self, i):
+        return self.exts[self.ext_codes[i]]
+
+    def paths(self, start=0, stop=None):
+        for i in range(start, len(self) if stop is None else min(stop, len(self))):
+            yield self.path(i)
+
+    def __iter__(self):
+        return self.paths()
@@ -0,0 +1,161 @@
+import os
+import csv
+import math
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+from . import framecodecs
+from .device import physical_cores
+
+# Frame quality metrics against ground truth (PSNR, SSIM, tOF) for any of the runners' outputs.
+# Sequences are split into chunks of consecutive frames which worker processes evaluate independently: every
+# image is decoded once (the frame before a chunk again, for tOF), SSIM filters are separable Gaussians on the
+# whole frame, and results are appended to the CSV in order as chunks finish.
+#
+#   PSNR - over all channels, 8-bit scale
+#   SSIM - on BT.601 Y (as in XVFI's evaluation), 11x11 Gaussian window with sigma 1.5, K1 0.01, K2 0.03 and a fixed
+#          255 data range. XVFI's ssim_bgr used skimage's 7x7 uniform window and the prediction's min-max range, so
+#          values are not comparable with logs from it
+#   tOF  - mean L2 difference of the Farneback flows prediction(t-1)->prediction(t) and GT(t-1)->GT(t)
+
+METRICS = ('PSNR', 'SSIM', 'tOF')
+SSIM_SIGMA = 1.5
+SSIM_RADIUS = 5
+Y_COEFFS = np.array([0.097905882352941, 0.504129411764706, 0.256788235294118])  # B, G, R weights of BT.601 Y
+
+def _gaussian_kernel(sigma=SSIM_SIGMA, radius=SSIM_RADIUS):
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-x * x / (2 * sigma * sigma))
+    return kernel / kernel.sum()
+
+SSIM_KERNEL = _gaussian_kernel()
+
+def read(path):
+    # Any framecodecs format, as float64 BGR on an 8-bit scale
+    img = framecodecs.read(path)
+    if img is None:
+        raise RuntimeError("Could not read " + path)
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    scale = 257.0 if img.dtype == np.uint16 else 1.0
+    img = img[:, :, :3].astype(np.float64)
+    return img / scale if scale != 1.0 else img
+
+def luma(img):
+    return img @ Y_COEFFS + 16.0
+
+def psnr(pred, gt):
+    mse = np.mean(np.square(pred - gt))
+    return float('inf') if mse == 0 else 20 * math.log10(255.0 / math.sqrt(mse))
+
+def _blur(img):
+    return cv2.sepFilter2D(img, cv2.CV_64F, SSIM_KERNEL, SSIM_KERNEL, borderType=cv2.BORDER_REFLECT)
+
+def ssim(pred_y, gt_y, data_range=255.0):
+    c1, c2 = (0.01 * data_range) ** 2, (0.03 * data_range) ** 2
+    mu_p, mu_g = _blur(pred_y), _blur(gt_y)
+    var_p = _blur(pred_y * pred_y) - mu_p * mu_p
+    var_g = _blur(gt_y * gt_y) - mu_g * mu_g
+    cov = _blur(pred_y * gt_y) - mu_p * mu_g
+    ssim_map = ((2 * mu_p * mu_g + c1) * (2 * cov + c2)) / ((mu_p * mu_p + mu_g * mu_g + c1) * (var_p + var_g + c2))
+    r = SSIM_RADIUS  # Window centers closer to the border would see reflected pixels
+    return float(ssim_map[r:-r, r:-r].mean())
+
+def grey(img):
+    return cv2.cvtColor(img.astype(np.float32), cv2.COLOR_BGR2GRAY)
+
+def flow(prev_grey, grey_img):
+    return cv2.calcOpticalFlowFarneback(prev_grey, grey_img, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+
+def save_flow_diff(path, flow_diff, max_value=0.4):
+    # Direction as hue, magnitude (clipped at max_value) as brightness
+    hsv = np.zeros(flow_diff.shape[:2] + (3,), np.uint8)
+    hsv[..., 1] = 255
+    mag, ang = cv2.cartToPolar(flow_diff[..., 0], flow_diff[..., 1])
+    hsv[..., 0] = np.round(ang * 180 / np.pi / 2) % 180
+    hsv[..., 2] = np.round(np.clip(mag, 0.0, max_value) / max_value * 255.0)
+    cv2.imwrite(path, cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR))
+
+def _init_worker():
+    cv2.setNumThreads(1)  # One frame per process, OpenCV's own pool would oversubscribe the cores
+
+def _evaluate_chunk(task):
+    scene, items, prev, metrics, flow_dir = task
+    rows = []
+    prev_grey = None
+    if 'tOF' in metrics and prev is not None:
+        prev_pred_grey = grey(read(prev[0]))
+        prev_grey = (prev_pred_grey, prev_pred_grey if prev[1] == prev[0] else grey(read(prev[1])))
+    for name, pred_path, gt_path in items:
+        pred, gt = read(pred_path), read(gt_path)
+        if pred.shape != gt.shape:
+            raise RuntimeError("{} is {}x{} but {} is {}x{}".format(pred_path, pred.shape[1], pred.shape[0], gt_path, gt.shape[1], gt.shape[0]))
+        values = []
+        for metric in metrics:
+            if metric == 'PSNR':
+                values.append(psnr(pred, gt))
+            elif metric == 'SSIM':
+                values.append(ssim(luma(pred), luma(gt)))
+            elif metric == 'tOF':
+                cur_grey = (grey(pred), grey(gt))
+                if prev_grey is None:
+                    values.append(float('nan'))  # First frame of a sequence without a start frame has no motion to compare
+                else:
+                    flow_diff = np.abs(flow(prev_grey[1], cur_grey[1]) - flow(prev_grey[0], cur_grey[0]))
+                    values.append(float(np.sqrt(np.sum(flow_diff * flow_diff, axis=-1)).mean()))
+                    if flow_dir is not None:
+                        save_flow_diff(os.path.join(flow_dir, "tOF_flow_{}.png".format(os.path.splitext(name)[0])), flow_diff)
+                prev_grey = cur_grey
+        rows.append((scene, name, values))
+    return rows
+
+def evaluate(sequences, csv_path, metrics=METRICS, workers=0, chunk=8, flow_root=None, log=print):
+    """
+    sequences: [(scene, [(name, pred_path, gt_path), ...], start)], frames in temporal order. start is None or the
+    (pred_path, gt_path) of the frame before the first item, the reference for its tOF (a source frame: both the same).
+    Writes one CSV row per frame and returns {scene: {metric: [values]}}. flow_root saves tOF visualizations per scene.
+    """
+    metrics = [m for m in METRICS if m in metrics]
+    tasks = []
+    for scene, items, start in sequences:
+        flow_dir = None
+        if flow_root is not None and 'tOF' in metrics:
+            flow_dir = os.path.join(flow_root, scene + '_tOF_flow')
+            os.makedirs(flow_dir, exist_ok=True)
+        for i in range(0, len(items), chunk):
+            prev = start if i == 0 else items[i - 1][1:]
+            tasks.append((scene, items[i:i + chunk], prev, metrics, flow_dir))
+
+    results = {}
+    workers = workers or min(physical_cores(), max(len(tasks), 1))
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['scene', 'frame'] + metrics)
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker) if workers > 1 else None
+        futures = []
+        try:
+            if pool is not None:
+                futures = [pool.submit(_evaluate_chunk, task) for task in tasks]
+                chunks = (future.result() for future in futures)
+            else:
+                chunks = map(_evaluate_chunk, tasks)
+            for rows in chunks:
+                for scene, name, values in rows:
+                    writer.writerow([scene, name] + ['{:.6f}'.format(v) for v in values])
+                    scene_results = results.setdefault(scene, {m: [] for m in metrics})
+                    for metric, value in zip(metrics, values):
+                        scene_results[metric].append(value)
+                    if log is not None:
+                        log("{}/{}: ".format(scene, name) + ", ".join("{} {:.4f}".format(m, v) for m, v in zip(metrics, values)))
+                f.flush()
+        finally:
+            if pool is not None:
+                for future in futures:  # On an error, drop the chunks not started yet (shutdown(cancel_futures) needs 3.9)
+                    future.cancel()
+                pool.shutdown()
+    return results
+
+def mean(values):
+    # Average over the frames that have the metric (tOF is NaN for a sequence's first frame without a start)
+    values = [v for v in values if not math.isnan(v)]
+    return sum(values) / len(values) if values else float('nan')
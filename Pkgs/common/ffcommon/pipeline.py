@@ -0,0 +1,133 @@
+import sys
+import threading
+import traceback
+from .buffers import ByteQueue, Cancelled
+
+# Small threaded streaming pipeline shared by the runners: bounded queues between a source thread,
+# worker-pool stages and sinks, with ordered reassembly, EOF propagation and cancellation on the first error.
+#
+#   with Pipeline() as pipe:
+#       frames = pipe.queue(max_bytes, name='Read buffer')
+#       pipe.source(frames, read_frames())
+#       for frame in pipe.drain(frames):
+#           ...
+#
+# Leaving the with block joins all threads (after the last pipe.close() on the sink queues) and re-raises the
+# first worker error. An exception in the main thread cancels all queues so blocked workers exit promptly.
+
+EOF = object()
+
+class Pipeline:
+    def __init__(self):
+        self.queues = []
+        self.threads = []
+        self.error = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.cancel()
+        self.join()
+        if self.error is not None and (exc_type is None or exc_type is Cancelled):
+            raise self.error
+        return False
+
+    def queue(self, max_bytes, max_items=0, name='queue'):
+        q = ByteQueue(max_bytes, max_items, name)
+        self.queues.append(q)
+        return q
+
+    def spawn(self, fn, *args, name=None):
+        def run():
+            try:
+                fn(*args)
+            except Cancelled:
+                pass
+            except BaseException as e:
+                self.fail(e)
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+        return thread
+
+    def fail(self, exc):
+        with self.lock:
+            if self.error is not None:
+                return
+            self.error = exc
+        print(f"Pipeline error in {threading.current_thread().name}:", file=sys.stderr)
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+        self.cancel()
+
+    def cancel(self):
+        for q in self.queues:
+            q.cancel()
+
+    @property
+    def cancelled(self):
+        return any(q.cancelled for q in self.queues)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def close(self, q):
+        q.put(EOF)
+
+    def drain(self, q):
+        while True:
+            item = q.get()
+            if item is EOF:
+                return
+            yield item
+
+    def source(self, out_q, iterable, name='source'):
+        # Feeds an iterable into out_q from its own thread, then EOF
+        def run():
+            for item in iterable:
+                out_q.put(item)
+            out_q.put(EOF)
+        return self.spawn(run, name=name)
+
+    def stage(self, in_q, out_q, fn, workers=1, ordered=True, name='stage'):
+        # Applies fn to each item with a pool of worker threads. Results of None are dropped. With ordered=True
+        # results reach out_q in input order, otherwise as they finish. out_q=None makes this a sink.
+        take_lock = threading.Lock()
+        emit = threading.Condition()
+        state = {'next_in': 0, 'next_out': 0, 'alive': workers}
+
+        def run():
+            try:
+                while True:
+                    with take_lock:
+                        item = in_q.get()
+                        if item is EOF:
+                            in_q.put(EOF)  # Let the other workers see it too
+                            return
+                        seq = state['next_in']
+                        state['next_in'] += 1
+                    result = fn(item)
+                    with emit:
+                        if ordered:
+                            while state['next_out'] != seq:
+                                if self.cancelled:
+                                    raise Cancelled(name)
+                                emit.wait(0.1)
+                        if out_q is not None and result is not None:
+                            out_q.put(result)
+                        state['next_out'] += 1
+                        emit.notify_all()
+            finally:
+                with emit:
+                    state['alive'] -= 1
+                    last = state['alive'] == 0
+                if last and out_q is not None and not self.cancelled:
+                    out_q.put(EOF)
+
+        return [self.spawn(run, name=f"{name}_{i}") for i in range(workers)]
+
+    def sink(self, in_q, fn, workers=1, name='sink'):
+        return self.stage(in_q, None, fn, workers, ordered=False, name=name)
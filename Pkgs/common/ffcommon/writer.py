@@ -0,0 +1,167 @@
+import os
+import math
+import time
+import shutil
+import threading
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from . import framecodecs
+from .buffers import Cancelled
+from .pipeline import EOF
+
+def copy_file_fast(src, dst, allow_link=True):
+    # Cheapest first: hardlink, then copy-on-write clone (Linux FICLONE), then a plain byte copy.
+    # Goes through a temp name so dst appears atomically. Returns how the file was placed.
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    kind = 'copied'
+    try:
+        if not allow_link:
+            raise OSError
+        os.link(src, tmp)
+        kind = 'linked'
+    except OSError:
+        try:
+            import fcntl
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())
+            kind = 'reflinked'
+        except (ImportError, OSError):
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return kind
+
+class FrameWriter:
+    # Pipeline sink writing (frame_num, frame) items as '{:0>8d}.{fmt}' into out_dir. A frame is an array
+    # (RGB if rgb=True, else BGR) or a source file path, which is linked/copied as-is when its extension
+    # matches fmt (passthrough 'auto' allows hardlinks, 'copy' does not, 'off' always re-encodes).
+    # Frames in flight follow arrival rate x write time, capped at max_workers, and under backlog the PNG
+    # level moves to make the slower half (encode or disk) cheaper. Files are written to a temp name and
+    # renamed so consumers never see partial frames. Completions are tracked in queue order: written_through is the
+    # last frame number up to which every frame is on disk, so a consumer can safely read everything before it.
+    def __init__(self, pipe, queue, out_dir, fmt, max_workers, level=2, max_level=4, rgb=False, passthrough='auto', log=True):
+        self.pipe = pipe
+        self.queue = queue
+        self.out_dir = os.path.abspath(out_dir)
+        self.fmt = fmt
+        self.rgb = rgb
+        self.passthrough = passthrough
+        self.log = log
+        self.max_workers = max(1, max_workers)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='T')
+        self.base_level = self.level = level
+        self.max_level = max(level, max_level)
+        self.target = self.peak = 1
+        self.active = 0
+        self.cond = threading.Condition()
+        self.encode_time = self.write_time = None
+        self.window_start, self.window_count, self.window_qsize = time.perf_counter(), 0, 0
+        self.level_counts = Counter()
+        self.copy_counts = Counter()
+        self.submitted = self.completed = 0
+        self.finished_out_of_order = {}
+        self.written_through = None
+        self.bytes_written = 0
+        self.first_submit = self.last_finish = None
+        pipe.spawn(self.dispatch, name='writer')
+
+    def dispatch(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is EOF:
+                    break
+                with self.cond:
+                    while self.active >= self.target:
+                        if self.pipe.cancelled:
+                            raise Cancelled('writer')
+                        self.cond.wait(0.1)
+                    self.active += 1
+                    self.peak = max(self.peak, self.active)
+                    seq = self.submitted
+                    self.submitted += 1
+                    if self.first_submit is None:
+                        self.first_submit = time.perf_counter()
+                self.window_count += 1
+                self.pool.submit(self.write, item, self.level).add_done_callback(functools.partial(self.finished, seq, item[0]))
+                self.retune()
+        finally:
+            self.pool.shutdown(wait=True)
+        if self.completed != self.submitted and not self.pipe.cancelled:
+            raise RuntimeError(f"Writer finished with {self.submitted - self.completed} of {self.submitted} frames unwritten")
+
+    def write(self, item, level):
+        frame_num, img = item
+        name = '{:0>8d}.{}'.format(frame_num, self.fmt)
+        if self.log:
+            print('[T{}] => {}'.format(threading.current_thread().name.rsplit('_', 1)[-1], name))
+        dst = os.path.join(self.out_dir, name)
+        if isinstance(img, str):
+            if self.passthrough != 'off' and os.path.splitext(img)[1][1:].lower() == self.fmt.lower():
+                kind = copy_file_fast(img, dst, self.passthrough == 'auto')
+                with self.cond:
+                    self.copy_counts[kind] += 1
+                    self.bytes_written += os.path.getsize(dst)
+                return
+            img = framecodecs.read(img)
+        elif self.rgb:
+            img = img[:, :, ::-1]
+        start = time.perf_counter()
+        data = framecodecs.encode(img, self.fmt, level)
+        encoded = time.perf_counter()
+        with open(dst + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(dst + '.tmp', dst)
+        with self.cond:
+            # Exponential moving averages of the per-frame cost, split into CPU (encode) and disk (write)
+            written = time.perf_counter() - encoded
+            self.encode_time = encoded - start if self.encode_time is None else 0.8 * self.encode_time + 0.2 * (encoded - start)
+            self.write_time = written if self.write_time is None else 0.8 * self.write_time + 0.2 * written
+            self.level_counts[level] += 1
+            self.bytes_written += len(data)
+
+    def finished(self, seq, frame_num, future):
+        if future.exception() is not None:
+            self.pipe.fail(future.exception())
+        with self.cond:
+            self.active -= 1
+            if future.exception() is None:
+                # Advance the watermark over every frame that is now contiguous with it
+                self.finished_out_of_order[seq] = frame_num
+                while self.completed in self.finished_out_of_order:
+                    self.written_through = self.finished_out_of_order.pop(self.completed)
+                    self.completed += 1
+                self.last_finish = time.perf_counter()
+            self.cond.notify_all()
+
+    def retune(self):
+        now = time.perf_counter()
+        if now - self.window_start < 0.5 or self.encode_time is None:
+            return
+        qsize = self.queue.qsize()
+        fill = self.queue.fill()
+        arrival = (self.window_count + qsize - self.window_qsize) / (now - self.window_start)
+        with self.cond:
+            needed = math.ceil(arrival * (self.encode_time + self.write_time) * 1.25)
+            self.target = self.max_workers if fill > 0.5 else min(self.max_workers, max(1, needed))
+            self.cond.notify_all()
+            if fill > 0.5:
+                self.level = min(self.level + 1, self.max_level) if self.write_time > self.encode_time else max(self.level - 1, 0)
+            elif fill < 0.1 and self.level != self.base_level:
+                self.level += 1 if self.level < self.base_level else -1
+        self.window_start, self.window_count, self.window_qsize = now, 0, qsize
+
+    def stats(self):
+        lines = [f"Writer: peak {self.peak}/{self.max_workers} threads"]
+        if self.fmt.lower() == 'png' and self.level_counts:
+            lines[0] += ", PNG levels used {" + ", ".join(f"{lvl}: {n}" for lvl, n in sorted(self.level_counts.items())) + "}"
+        if self.copy_counts:
+            lines.append("Source frames: " + ", ".join(f"{n} {kind}" for kind, n in sorted(self.copy_counts.items())) + " without re-encoding")
+        if self.completed and self.last_finish > self.first_submit:
+            # From the first frame handed to the pool to the last one on disk, so idle time before the first frame is excluded
+            elapsed = self.last_finish - self.first_submit
+            lines.append(f"Written: {self.completed} frames, {self.bytes_written / 1024 ** 2:.1f} MB in {elapsed:.2f}s "
+                         f"({self.completed / elapsed:.1f} frames/s, {self.bytes_written / 1024 ** 2 / elapsed:.1f} MB/s)")
+        return lines
@@ -0,0 +1,29 @@
+import os
+import sys
+import argparse
+
+# Streams a folder of numbered frames (any framecodecs format) to stdout as raw video for ffmpeg, e.g.
+#   python framecat.py --input frames | ffmpeg -f rawvideo -pix_fmt bgr24 -s WxH -r 60 -i - out.mp4
+# The frame size and pixel format are printed to stderr before the first frame.
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from ffcommon import framecodecs
+
+parser = argparse.ArgumentParser(description='Decode numbered frames to a raw video stream on stdout')
+parser.add_argument('--input', required=True)
+parser.add_argument('--delete', action='store_true', help='Delete each frame after it has been written')
+args = parser.parse_args()
+
+files = sorted((f for f in os.listdir(args.input) if os.path.splitext(f)[0].isdigit()), key=lambda f: int(os.path.splitext(f)[0]))
+out = sys.stdout.buffer
+for i, f in enumerate(files):
+    path = os.path.join(args.input, f)
+    img = framecodecs.read(path)
+    if i == 0:
+        channels = 1 if img.ndim == 2 else img.shape[2]
+        pix_fmt = {1: 'gray', 3: 'bgr24', 4: 'bgra'}[channels] if img.dtype.itemsize == 1 else {1: 'gray16le', 3: 'bgr48le', 4: 'bgra64le'}[channels]
+        print(f"{img.shape[1]}x{img.shape[0]} {pix_fmt}", file=sys.stderr)
+    out.write(img.tobytes())
+    if args.delete:
+        os.remove(path)
+out.flush()
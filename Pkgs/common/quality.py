@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import argparse
+
+# Quality of interpolated frames against ground truth, for the output of any runner, e.g.
+#   python quality.py --pred interp --gt gt_frames --multiple 4
+# Frames are matched by their order in each folder. With --multiple N, every Nth frame is a source frame: it is not
+# scored, and is the tOF reference of the frames that follow it. Folders of scene subfolders are evaluated per scene.
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from ffcommon import metrics
+from ffcommon.frameindex import FrameIndex
+
+def scene_dirs(pred_root, gt_root):
+    index = FrameIndex(pred_root)
+    if len(index):
+        return [('', pred_root, gt_root)]
+    scenes = sorted(entry.name for entry in os.scandir(pred_root) if entry.is_dir() and not entry.name.startswith('.')
+                    and len(FrameIndex(entry.path)))
+    return [(scene, os.path.join(pred_root, scene), os.path.join(gt_root, scene)) for scene in scenes]
+
+def make_sequences(pred_root, gt_root, multiple):
+    sequences = []
+    for scene, pred_dir, gt_dir in scene_dirs(pred_root, gt_root):
+        pred, gt = FrameIndex(pred_dir), FrameIndex(gt_dir)
+        if len(pred) != len(gt):
+            raise RuntimeError("{} has {} frames but {} has {}".format(pred_dir, len(pred), gt_dir, len(gt)))
+        scene = scene or os.path.basename(os.path.normpath(pred_dir))
+        frames = [(pred.name(i), pred.path(i), gt.path(i)) for i in range(len(pred))]
+        if multiple < 2:
+            sequences.append((scene, frames, None))
+            continue
+        for start in range(0, len(frames) - 1, multiple):
+            sequences.append((scene, frames[start + 1:start + multiple], frames[start][1:]))
+    if not sequences:
+        raise RuntimeError("Found no frames in " + pred_root)
+    return sequences
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PSNR/SSIM/tOF of interpolated frames against ground truth')
+    parser.add_argument('--pred', required=True, help='Interpolated frames, or a folder of scene folders')
+    parser.add_argument('--gt', required=True, help='Ground truth frames, laid out like --pred')
+    parser.add_argument('--multiple', type=int, default=0, help='Interpolation factor, source frames are skipped. 0 = score every frame')
+    parser.add_argument('--metrics', nargs='+', default=list(metrics.METRICS), choices=metrics.METRICS)
+    parser.add_argument('--csv', default='metrics.csv', help='Per-frame results, written as they are computed')
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes, 0 = one per physical core')
+    parser.add_argument('--chunk', type=int, default=8, help='Consecutive frames per worker task')
+    parser.add_argument('--quiet', action='store_true', help='Only print the per-scene summary')
+    args = parser.parse_args()
+
+    sequences = make_sequences(args.pred, args.gt, args.multiple)
+    start_time = time.time()
+    results = metrics.evaluate(sequences, args.csv, args.metrics, args.workers, args.chunk, log=None if args.quiet else print)
+    elapsed = time.time() - start_time
+
+    n_frames = sum(len(items) for _, items, _ in sequences)
+    for scene, values in results.items():
+        print("{}: ".format(scene) + ", ".join("{} {:.4f}".format(m, metrics.mean(v)) for m, v in values.items()))
+    if len(results) > 1:
+        print("Total: " + ", ".join("{} {:.4f}".format(m, metrics.mean([v for s in results.values() for v in s[m]]))
+                                    for m in next(iter(results.values()))))
+    print("{} frames in {:.2f}s ({:.2f} frames/s), results in {}".format(n_frames, elapsed, n_frames / max(elapsed, 1e-6), args.csv))
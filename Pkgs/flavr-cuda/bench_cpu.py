@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import argparse
+import torch
+
+# CPU throughput of UNet_3D_3D at 2x/4x/8x: plain fp32 against channels-last weights and bf16 autocast.
+# Weights are random unless checkpoints are given, which does not change the amount of work.
+
+dname = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(dname)
+sys.path.append(os.path.join(os.path.dirname(dname), "common"))
+from ffcommon import device as ffdevice
+from model.FLAVR_arch import UNet_3D_3D
+
+parser = argparse.ArgumentParser(description='Benchmark FLAVR inference on CPU')
+parser.add_argument('--factors', type=int, nargs='+', default=[2, 4, 8], choices=[2, 4, 8])
+parser.add_argument('--models', nargs='*', default=[], help='Checkpoints matching --factors, random weights if omitted')
+parser.add_argument('--size', type=int, nargs=2, default=[256, 448], help='H W of the input frames')
+parser.add_argument('--batch', type=int, default=1, help='Windows per forward pass')
+parser.add_argument('--threads', type=int, default=0, help='Intra-op threads, 0 = one per physical core')
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--up_mode', default='transpose')
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device('cpu')
+threads = ffdevice.configure_cpu(args.threads)
+h, w = args.size
+print(f"{h}x{w}, batch {args.batch}, {threads} threads, bf16 {'supported' if ffdevice.bf16_supported() else 'not supported (emulated)'}")
+
+configs = [('fp32', False, False), ('fp32 channels-last', True, False)]
+if ffdevice.bf16_autocast_available():
+    configs.append(('bf16 channels-last', True, True))
+else:
+    print(f"bf16 skipped: CPU autocast needs torch 1.10 or newer, this is torch {torch.__version__}")
+for i, factor in enumerate(args.factors):
+    model = UNet_3D_3D('unet_18', n_inputs=4, n_outputs=factor - 1, joinType='concat', upmode=args.up_mode).eval()
+    if i < len(args.models):
+        state = ffdevice.load(args.models[i], device)['state_dict']
+        model.load_state_dict({k.partition("module.")[-1]: v for k, v in state.items()})
+    inputs = [torch.rand(args.batch, 3, h, w) for _ in range(4)]
+    for name, channels_last, bf16 in configs:
+        if channels_last:
+            model = ffdevice.channels_last(model)
+        with ffdevice.autocast(device, bf16):
+            model(inputs)  # Warmup, lets oneDNN pick and cache its kernels
+            start = time.perf_counter()
+            for _ in range(args.iters):
+                model(inputs)
+            elapsed = (time.perf_counter() - start) / args.iters
+        print(f"{factor}x {name:>18}: {elapsed * 1000 / args.batch:8.1f} ms/window, {args.batch * (factor - 1) / elapsed:6.2f} interpolated frames/s")
@@ -7,7 +7,9 @@ import sys
 import torchvision
 from PIL import Image
 import numpy as np
-import _thread
+import itertools
+import math
+from collections import deque
 from torchvision.io import read_video, write_video
 import torch.nn.functional as F
 
@@ -17,8 +19,13 @@ print("Changing working dir to {0}".format(dname))
 os.chdir(os.path.dirname(dname))
 print("Added {0} to temporary PATH".format(dname))
 sys.path.append(dname)
-
-from dataset.transforms import ToTensorVideo, Resize
+sys.path.append(os.path.join(os.path.dirname(dname), "common"))
+from ffcommon import buffers
+from ffcommon import device as ffdevice
+from ffcommon.pipeline import Pipeline
+from ffcommon.writer import FrameWriter
+from ffcommon.frameindex import FrameIndex
+from tiling import TILE_ALIGN, min_tile, tile_spans
 
 import argparse
 
@@ -30,9 +37,18 @@ parser.add_argument("--factor", type=int, choices=[2,4,8], help="How much interp
 parser.add_argument("--model", type=str, help="path for stored model")
 parser.add_argument("--up_mode", type=str, help="Upsample Mode", default="transpose")
 parser.add_argument('--fp16', dest='fp16', action='store_true', help='half-precision mode')
-parser.add_argument('--imgformat', default="png")
+parser.add_argument('--device', dest='device', default='auto', choices=['auto', 'cuda', 'cpu'], help='Inference device, auto = CUDA if available')
+parser.add_argument('--threads', dest='threads', type=int, default=0, help='CPU intra-op threads, 0 = one per physical core')
+parser.add_argument('--bf16', dest='bf16', action='store_true', help='bfloat16 autocast on CPU')
+parser.add_argument('--imgformat', default="png", help='Output image format, or a fast intermediate codec: raw, lz4, zst, qoiv')
 parser.add_argument("--output_ext", type=str, help="Output video format", default=".avi")
 parser.add_argument("--input_ext", type=str, help="Input video format", default=".mp4")
+parser.add_argument('--batch', dest='batch', type=int, default=0, help='Windows per forward pass, 0 = auto from resolution and free memory')
+parser.add_argument('--tile', dest='tile', type=int, default=0, help='Spatial tile size in px, 0 = auto (only when a full frame does not fit), -1 = never tile')
+parser.add_argument('--tile-halo', dest='tile_halo', type=int, default=0, help='Context around each tile in px, 0 = half the receptive field')
+parser.add_argument('--wthreads', dest='wthreads', type=int, default=4, help='Max writer threads')
+parser.add_argument('--mem-budget', dest='mem_budget', type=float, default=0, help='Memory for the read/write buffers in MB, 0 = half of available RAM')
+parser.add_argument('--passthrough', dest='passthrough', default='auto', choices=['auto', 'copy', 'off'], help='Source frames: hardlink/reflink/copy files (auto), reflink/copy only (copy) or re-encode (off)')
 args = parser.parse_args()
 
 input_ext = args.input_ext
@@ -44,14 +60,24 @@ interp_output_path = os.path.join(dname, args.output)
 
 
 torch.set_grad_enabled(False)
-if torch.cuda.is_available():
+device = ffdevice.select(args.device)
+bf16 = False
+if device.type == 'cuda':
     torch.backends.cudnn.enabled = True
     torch.backends.cudnn.benchmark = True
     if(args.fp16):
         torch.set_default_tensor_type(torch.cuda.HalfTensor)
         print("FLAVR is running in FP16 mode.")
 else:
-    print("WARNING: CUDA is not available, FLAVR is running on CPU! [ff:nocuda-cpu]")
+    if not torch.cuda.is_available():
+        print("WARNING: CUDA is not available, FLAVR is running on CPU! [ff:nocuda-cpu]")
+    threads = ffdevice.configure_cpu(args.threads)
+    bf16 = args.bf16 and ffdevice.bf16_supported() and ffdevice.bf16_autocast_available()
+    if args.bf16 and not ffdevice.bf16_autocast_available():
+        print(f"WARNING: bfloat16 autocast on CPU needs torch 1.10 or newer (this is {torch.__version__}), running in FP32.")
+    elif args.bf16 and not bf16:
+        print("WARNING: this CPU has no native bfloat16 support, running in FP32.")
+    print(f"FLAVR CPU mode: {threads} threads, channels-last weights{', bfloat16 autocast' if bf16 else ''}.")
 
 
 n_outputs = args.factor - 1
@@ -62,7 +88,7 @@ joinType = "concat"
 
 def loadModel(model, checkpoint):
     
-    saved_state_dict = torch.load(checkpoint)['state_dict']
+    saved_state_dict = ffdevice.load(checkpoint, device)['state_dict']
     saved_state_dict = {k.partition("module.")[-1]:v for k,v in saved_state_dict.items()}
     model.load_state_dict(saved_state_dict)
 
@@ -71,83 +97,169 @@ from model.FLAVR_arch import UNet_3D_3D
 
 model = UNet_3D_3D(model_name.lower(), n_inputs=4, n_outputs=n_outputs,  joinType=joinType, upmode=args.up_mode)
 loadModel(model, checkpoint)
-model = model.cuda()
-
-in_files = sorted(os.listdir(interp_input_path))
-
-def make_image(img):
-    q_im = img.data.mul(255.).clamp(0,255).round()
-    im = q_im.permute(1, 2, 0).cpu().numpy().astype(np.uint8)
-    im = cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
-    return im
-
-def files_to_videoTensor(path):
-    from PIL import Image
-    global in_files
-    in_files_fixed = in_files
-    in_files_fixed.insert(0, in_files[0])   # Workaround: Insert extra entry before
-    in_files_fixed.append(in_files[-1])   # Workaround: Insert extra entry after
-    images = [torch.Tensor(np.asarray(Image.open(os.path.join(path, f)))).type(torch.uint8) for f in in_files]
-    print(images[0].shape)
-    videoTensor = torch.stack(images)
-    return videoTensor
-
-def video_transform(videoTensor):
-    T, H, W = videoTensor.size(0), videoTensor.size(1), videoTensor.size(2)
-    transforms = torchvision.transforms.Compose([ToTensorVideo()])
-    videoTensor = transforms(videoTensor)
-    return videoTensor
-
-videoTensor = files_to_videoTensor(interp_input_path)
-
-print(f"Video Tensor len: {len(videoTensor)}")
-idxs = torch.Tensor(range(len(videoTensor))).type(torch.long).view(1, -1).unfold(1,size=nbr_frame,step=1).squeeze(0)
-print(f"len(idxs): {len(idxs)}")
-videoTensor = video_transform(videoTensor)
-print("Video tensor shape is ", videoTensor.shape)
-
-frames = torch.unbind(videoTensor, 1)
-n_inputs = len(frames)
-width = n_outputs + 1
+model = model.to(device)
+if device.type == 'cpu':
+    model = ffdevice.channels_last(model)
+
+frame_index = FrameIndex(interp_input_path)
+
+# Peak memory of one window through unet_18 measured at 6-7.5 KB per pixel in fp32, rounded up
+WINDOW_BYTES_PER_PIXEL = 8 * 1024
+MAX_BATCH = 8
+
+# Receptive field of unet_18 along H and W: 7x7/2 stem, 14 3x3 convs at strides 2-8, 3x3 decoder convs,
+# three 4x4/2 transposed convs and the 7x7 out conv add up to 211 px. The encoder downsamples by 8, so tiles
+# start on multiples of 8 to see the same conv phase as the full frame.
+RECEPTIVE_FIELD = 211
+
+def free_memory():
+    if device.type == 'cuda':
+        if hasattr(torch.cuda, 'mem_get_info'):  # torch 1.10+
+            return torch.cuda.mem_get_info(device)[0]
+        return torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+    return buffers.available_memory() or 4096 * 1024 ** 2
+
+def window_bytes(pixels):
+    return WINDOW_BYTES_PER_PIXEL * pixels // (2 if args.fp16 or bf16 else 1)
+
+def tile_halo():
+    halo = args.tile_halo or RECEPTIVE_FIELD // 2
+    return -(-halo // TILE_ALIGN) * TILE_ALIGN
+
+def auto_tile(height, width):
+    # Largest square tile whose activations fit in half of the free memory, or 0 when the full frame fits
+    if args.tile < 0:
+        return 0
+    smallest = min_tile(tile_halo())
+    if args.tile > 0:
+        tile = args.tile // TILE_ALIGN * TILE_ALIGN
+    elif window_bytes(height * width) <= free_memory() // 2:
+        return 0
+    else:
+        tile = int(math.sqrt(free_memory() // 2 / window_bytes(1))) // TILE_ALIGN * TILE_ALIGN
+    if tile < smallest and smallest < max(height, width):
+        print(f"Warning: {tile}px tiles would be mostly {tile_halo()}px halo, using the minimum of {smallest}px instead"
+              f"{'' if args.tile > 0 else ', which may not fit in memory'}")
+        tile = smallest
+    return tile if tile < max(height, width) else 0
+
+def auto_batch(height, width):
+    # As many windows per forward pass as fit in half of the free device memory
+    if args.batch > 0:
+        return args.batch
+    return max(1, min(MAX_BATCH, free_memory() // 2 // window_bytes(height * width)))
+
+def blend_weights(spans):
+    # Per tile 1-D weights over its output region: linear ramps across the overlaps with its neighbours.
+    # The last tile can overlap more than one neighbour, so results are normalized by the summed weights
+    weights = []
+    for k, (_, _, a, b) in enumerate(spans):
+        w = torch.ones(b - a)
+        pos = torch.arange(b - a) + 0.5
+        if k > 0:
+            w = torch.minimum(w, pos / (spans[k - 1][3] - a))
+        if k < len(spans) - 1:
+            w = torch.minimum(w, (b - a - pos) / (b - spans[k + 1][2]))
+        weights.append(w.to(device))
+    return weights
+
+def tiled_forward(inputs, tile):
+    # Runs the model tile by tile so peak activation memory follows the tile size instead of the frame size.
+    # The normalization mean is taken from the whole frames, so all tiles see the same input values
+    height, width = inputs[0].shape[-2:]
+    halo = tile_halo()
+    mean_ = model.window_mean(inputs)
+    rows, cols = tile_spans(height, tile, halo), tile_spans(width, tile, halo)
+    row_weights, col_weights = blend_weights(rows), blend_weights(cols)
+    outputs = [torch.zeros(inputs[0].shape, dtype=torch.float32, device=device) for _ in range(n_outputs)]
+    weight_sum = torch.zeros(height, width, device=device)
+    for (y0, y1, ya, yb), wy in zip(rows, row_weights):
+        for (x0, x1, xa, xb), wx in zip(cols, col_weights):
+            tile_out = model([f[..., y0:y1, x0:x1] for f in inputs], mean_)
+            weight = wy[:, None] * wx[None, :]
+            weight_sum[ya:yb, xa:xb] += weight
+            for acc, out in zip(outputs, tile_out):
+                acc[..., ya:yb, xa:xb] += out[..., ya - y0:yb - y0, xa - x0:xb - x0].float() * weight
+    return [acc / weight_sum for acc in outputs]
+
+def make_images(outputs):
+    # (B, 3, H, W) per output position -> B lists of n_outputs RGB uint8 HWC arrays, one device-to-host copy
+    q_im = torch.stack(outputs, 1).float().mul(255.).clamp(0,255).round().byte()
+    ims = q_im.permute(0, 1, 3, 4, 2).cpu().numpy()
+    return [list(window) for window in ims]
+
+def read_frames():
+    # Workaround: first and last frame are repeated so every source frame gets a full window
+    # Same conversion as ToTensorVideo, per frame: uint8 HWC -> float CHW in [0, 1]
+    last = len(frame_index) - 1
+    for i in itertools.chain([0], range(len(frame_index)), [last]):
+        img = np.array(Image.open(frame_index.path(i)))
+        yield torch.from_numpy(img).permute(2, 0, 1).float() / 255.0
+
+def window_batches(frames, batch):
+    # Ring of the batch + nbr_frame - 1 consecutive frames that cover `batch` windows; consecutive batches
+    # overlap by nbr_frame - 1 frames. Memory stays O(batch) for any clip length
+    ring = deque(maxlen=batch + nbr_frame - 1)
+    pending = 0
+    for frame in frames:
+        ring.append(frame)
+        pending += len(ring) >= nbr_frame
+        if pending == batch:
+            yield list(ring)
+            pending = 0
+    if pending:
+        yield list(ring)[-(pending + nbr_frame - 1):]
+
+width, height = Image.open(frame_index.path(0)).size
+tile = auto_tile(height, width)
+batch = auto_batch(min(height, tile or height), min(width, tile or width))
+print(f"Input frames: {len(frame_index)}, windows: {max(len(frame_index) - 1, 0)}, batch: {batch} windows per pass")
+if tile:
+    print(f"Tiling: {len(tile_spans(height, tile, tile_halo()))}x{len(tile_spans(width, tile, tile_halo()))} tiles of up to {tile}px with a {tile_halo()}px halo")
 
 
 model = model.eval()
 
 frame_num = 1
 
-def load_and_write_img (writedir, writename, path_load):
-    os.chdir(writedir)
-    cv2.imwrite(writename, cv2.imdecode(np.fromfile(path_load, dtype=np.uint8), cv2.IMREAD_UNCHANGED), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+mem_budget = buffers.memory_budget(args.mem_budget)
+pipe = Pipeline()
+# The reader thread decodes up to one batch of frames ahead of the batch being interpolated
+read_buffer = pipe.queue(mem_budget // 4, max(batch, nbr_frame), name='Read buffer')
+pipe.source(read_buffer, read_frames(), name='reader')
+write_buffer = pipe.queue(mem_budget // 2, name='Write buffer')
+writer = FrameWriter(pipe, write_buffer, interp_output_path, args.imgformat, args.wthreads, level=1, rgb=True, passthrough=args.passthrough, log=False)
 
-def write_img (writedir, writename, img):
-    os.chdir(writedir)
-    cv2.imwrite(writename, img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+with pipe:
+    i = 0
+    for frames in window_batches(pipe.drain(read_buffer), batch):
+        # Each frame is uploaded once; window b of the batch is frames b..b+3, taken as views along the batch dim
+        clip = torch.stack(frames).to(device)
+        n_windows = len(frames) - nbr_frame + 1
+        inputs = [clip[k:k + n_windows] for k in range(nbr_frame)]
+        with torch.no_grad(), ffdevice.autocast(device, bf16):
+            outputFrame = tiled_forward(inputs, tile) if tile else model(inputs)
 
+        for window_outputs in make_images(outputFrame):
+            print(f"Frame {i}")
 
-for i in (range(len(idxs))):
-    idxSet = idxs[i]
-    inputs = [frames[idx_].cuda().unsqueeze(0) for idx_ in idxSet]
-    with torch.no_grad():
-        outputFrame = model(inputs)   
-    outputFrame = [of.squeeze(0).cpu().data for of in outputFrame]
-    #outputs.extend(outputFrame)
-    #outputs.append(inputs[2].squeeze(0).cpu().data)
-    
-    print(f"Frame {i}")
-    
-    print(f"Writing source frame {'{:0>8d}.{}'.format(frame_num, args.imgformat)}")
-    input_frame_path = os.path.join(interp_input_path, in_files[i+1])
-    _thread.start_new_thread(load_and_write_img, (interp_output_path, '{:0>8d}.{}'.format(frame_num, args.imgformat), input_frame_path))
-    frame_num += 1
-    
-    for img in outputFrame:
-        print(f"Writing interp frame {'{:0>8d}.{}'.format(frame_num, args.imgformat)}")
-        _thread.start_new_thread(write_img, (interp_output_path, '{:0>8d}.{}'.format(frame_num, args.imgformat), make_image(img)))
-        frame_num += 1
+            print(f"Writing source frame {'{:0>8d}.{}'.format(frame_num, args.imgformat)}")
+            input_frame_path = frame_index.path(i)
+            write_buffer.put([frame_num, input_frame_path])
+            frame_num += 1
+
+            for img in window_outputs:
+                print(f"Writing interp frame {'{:0>8d}.{}'.format(frame_num, args.imgformat)}")
+                write_buffer.put([frame_num, img])
+                frame_num += 1
+            i += 1
 
-print(f"Writing source frame {frame_num} [LAST]")
-input_frame_path = os.path.join(interp_input_path, in_files[-1])
-os.chdir(interp_output_path)
-cv2.imwrite('{:0>8d}.{}'.format(frame_num, args.imgformat), cv2.imdecode(np.fromfile(input_frame_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED), [cv2.IMWRITE_PNG_COMPRESSION, 2])      # Last input frame
+    print(f"Writing source frame {frame_num} [LAST]")
+    input_frame_path = frame_index.path(-1)
+    write_buffer.put([frame_num, input_frame_path])      # Last input frame
+    pipe.close(write_buffer)
 
-time.sleep(0.5)
\ No newline at end of file
+print(read_buffer.stats())
+print(write_buffer.stats())
+for line in writer.stats():
+    print(line)
@@ -142,12 +142,18 @@ class UNet_3D_3D(nn.Module):
             nn.Conv2d(nf[3], out_channels , kernel_size=7 , stride=1, padding=0) 
         )         
 
-    def forward(self, images):
-
+    @staticmethod
+    def window_mean(images):
+        ## Batch mean normalization works slightly better than global mean normalization, thanks to https://github.com/myungsub/CAIN
         images = torch.stack(images , dim=2)
+        return images.mean(2, keepdim=True).mean(3, keepdim=True).mean(4,keepdim=True)
 
-        ## Batch mean normalization works slightly better than global mean normalization, thanks to https://github.com/myungsub/CAIN
-        mean_ = images.mean(2, keepdim=True).mean(3, keepdim=True).mean(4,keepdim=True)
+    def forward(self, images, mean_=None):
+        # mean_ can be passed in when images are spatial tiles, so every tile is normalized by the whole frame's mean
+        if mean_ is None:
+            mean_ = self.window_mean(images)
+
+        images = torch.stack(images , dim=2)
         images = images-mean_ 
 
         x_0 , x_1 , x_2 , x_3 , x_4 = self.encoder(images)
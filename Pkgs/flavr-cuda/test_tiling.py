@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from tiling import TILE_ALIGN, TILE_BLEND, min_tile, tile_spans
+
+def check_spans(length, tile, halo):
+    spans = tile_spans(length, tile, halo)
+    assert spans[0][2] == 0 and spans[-1][3] == length
+    for in_start, in_end, out_start, out_end in spans:
+        assert out_start % TILE_ALIGN == 0
+        assert in_start == max(0, out_start - halo) and in_end == min(length, out_end + halo)
+        assert in_end - in_start <= max(tile, TILE_BLEND + TILE_ALIGN + 2 * halo)
+    for prev, cur in zip(spans, spans[1:]):
+        assert cur[2] > prev[2]
+        assert prev[3] - cur[2] >= TILE_BLEND
+
+def test_smallest_tile():
+    for halo in range(TILE_ALIGN, 113, TILE_ALIGN):
+        tile = min_tile(halo)
+        for length in (tile + 1, tile + TILE_ALIGN, 360, 641, 1080, 3840):
+            check_spans(length, tile, halo)
+
+def test_below_smallest_tile():
+    # tile_spans keeps advancing even when called with a tile below min_tile
+    check_spans(640, 32, 8)
+    check_spans(640, 16, 8)
+
+def test_single_tile():
+    assert tile_spans(256, 256, 104) == [(0, 256, 0, 256)]
@@ -0,0 +1,24 @@
+# Tile geometry for flavr.py's spatial tiling, kept free of model and device state.
+# Tiles start on multiples of TILE_ALIGN (the encoder's downsampling) and neighbouring output regions overlap by
+# at least TILE_BLEND px for blending.
+
+TILE_ALIGN = 8
+TILE_BLEND = 16
+
+def min_tile(halo):
+    # Below a core of twice the halo most of each pass is recomputed context, which costs more than it saves.
+    # The core also has to exceed the blend overlap by a step, or consecutive tiles would not advance
+    return max(4 * halo, 2 * halo + TILE_BLEND + TILE_ALIGN)
+
+def tile_spans(length, tile, halo):
+    # (in_start, in_end, out_start, out_end) per tile along one axis. Output regions are the tiles minus their halo
+    # (none at the frame border) and overlap their neighbours by at least TILE_BLEND px for blending
+    if length <= tile:
+        return [(0, length, 0, length)]
+    core = max(tile - 2 * halo, TILE_BLEND + TILE_ALIGN)
+    starts = list(range(0, length - core + 1, core - TILE_BLEND))
+    last = (length - core) // TILE_ALIGN * TILE_ALIGN
+    if starts[-1] + core < length and last > starts[-1]:
+        starts.append(last)
+    ends = [start + core for start in starts[:-1]] + [length]
+    return [(max(0, a - halo), min(length, b + halo), a, b) for a, b in zip(starts, ends)]
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import argparse
+import importlib
+import numpy as np
+import cv2
+import torch
+from torch.nn import functional as F
+
+# Compares the recursive midpoint path of pre-v3.9 models against flow-once synthesis: speed, and PSNR when a trained
+# --model is given.
+# Pairs are taken --multi frames apart from a high frame rate sequence so the skipped frames act as ground truth.
+
+dname = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(dname)
+
+parser = argparse.ArgumentParser(description='Benchmark recursive vs flow-once interpolation')
+parser.add_argument('--arch', default='RIFE_HDv3', choices=['RIFE_HD', 'RIFE_HDv2', 'RIFE_HDv3'])
+parser.add_argument('--model', default=None, help='Trained model dir, random weights and no PSNR if omitted (speed only)')
+parser.add_argument('--input', default=None, help='Frame dir, synthetic panning texture if omitted')
+parser.add_argument('--multi', type=int, default=8, help='Power of two, the recursive path halves each interval')
+parser.add_argument('--pairs', type=int, default=4)
+parser.add_argument('--scale', type=float, default=1.0)
+parser.add_argument('--size', type=int, nargs=2, default=[256, 448], help='H W of the synthetic sequence')
+args = parser.parse_args()
+if args.multi < 2 or args.multi & (args.multi - 1):
+    parser.error(f"--multi must be a power of two, the recursive path cannot produce {args.multi - 1} frames per pair")
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+torch.set_grad_enabled(False)
+
+model = importlib.import_module(f"model.{args.arch}").Model()
+if args.model is not None:
+    if not os.path.isdir(args.model):
+        parser.error(f"--model {args.model} is not a model directory")
+    model.load_model(args.model, -1)
+else:
+    print("WARNING: no --model, the weights are untrained and PSNR is meaningless, only speed is reported.")
+model.eval()
+model.device()
+
+def load_frames():
+    count = args.pairs * args.multi + 1
+    if args.input is not None:
+        files = sorted(f for f in os.listdir(args.input) if f.endswith('.png') or f.endswith('.jpg'))[:count]
+        return [cv2.imread(os.path.join(args.input, f))[:, :, ::-1].copy() for f in files]
+    h, w = args.size
+    rng = np.random.default_rng(0)
+    texture = cv2.resize(rng.integers(0, 255, (h // 8, w // 4, 3), dtype=np.uint8), (w * 2, h), interpolation=cv2.INTER_CUBIC)
+    return [texture[:, i * 2:i * 2 + w].copy() for i in range(count)]
+
+def to_tensor(img):
+    img = torch.from_numpy(np.transpose(img, (2, 0, 1))).to(device).unsqueeze(0).float() / 255.
+    h, w = img.shape[2:]
+    tmp = max(128, int(128 / args.scale))
+    return F.pad(img, (0, ((w - 1) // tmp + 1) * tmp - w, 0, ((h - 1) // tmp + 1) * tmp - h))
+
+def recursive(I0, I1, n):
+    middle = model.inference(I0, I1, args.scale)
+    if n == 1:
+        return [middle]
+    return [*recursive(I0, middle, n // 2), middle, *recursive(middle, I1, n // 2)]
+
+def psnr(pred, gt):
+    mse = np.mean((pred.astype(np.float32) - gt.astype(np.float32)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+frames = load_frames()
+h, w = frames[0].shape[:2]
+n = args.multi - 1
+paths = {
+    'recursive': lambda I0, I1: recursive(I0, I1, n),
+    'flow-once': lambda I0, I1: model.inference_multi(I0, I1, [(i + 1) / args.multi for i in range(n)], args.scale),
+}
+for name, fn in paths.items():
+    fn(to_tensor(frames[0]), to_tensor(frames[args.multi]))  # Warmup
+    elapsed, scores = 0.0, []
+    for p in range(args.pairs):
+        first = p * args.multi
+        I0, I1 = to_tensor(frames[first]), to_tensor(frames[first + args.multi])
+        sync()
+        start = time.perf_counter()
+        out = fn(I0, I1)
+        sync()
+        elapsed += time.perf_counter() - start
+        for i, mid in enumerate(out if args.model is not None else []):
+            pred = (mid[0] * 255.).clamp(0, 255).byte().cpu().numpy().transpose(1, 2, 0)[:h, :w]
+            scores.append(psnr(pred, frames[first + i + 1]))
+    quality = f", PSNR {np.mean(scores):.2f} dB" if scores else ""
+    print(f"{name:>10}: {elapsed / args.pairs * 1000:8.1f} ms/pair, {args.pairs * n / elapsed:6.2f} frames/s{quality}")
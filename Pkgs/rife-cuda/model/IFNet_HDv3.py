@@ -21,6 +21,19 @@ def conv_bn(in_planes, out_planes, kernel_size=3, stride=1, padding=1, dilation=
         nn.PReLU(out_planes)
     )
 
+def conv_flops(layer, h, w):
+    """Multiply-accumulates of a Conv2d/ConvTranspose2d on an h x w input, plus its output size."""
+    kh, kw = layer.kernel_size
+    sh, sw = layer.stride
+    ph, pw = layer.padding
+    if isinstance(layer, nn.ConvTranspose2d):
+        oh, ow = (h - 1) * sh - 2 * ph + kh, (w - 1) * sw - 2 * pw + kw
+        macs = h * w * layer.in_channels * layer.out_channels // layer.groups * kh * kw
+    else:
+        oh, ow = (h + 2 * ph - kh) // sh + 1, (w + 2 * pw - kw) // sw + 1
+        macs = oh * ow * layer.in_channels * layer.out_channels // layer.groups * kh * kw
+    return macs, oh, ow
+
 class IFBlock(nn.Module):
     def __init__(self, in_planes, c=64):
         super(IFBlock, self).__init__()
@@ -62,6 +75,19 @@ class IFBlock(nn.Module):
         flow = F.interpolate(flow, scale_factor=scale*2, mode="bilinear", align_corners=False, recompute_scale_factor=False) * scale*2
         mask = F.interpolate(mask, scale_factor=scale*2, mode="bilinear", align_corners=False, recompute_scale_factor=False)
         return flow, mask
+
+    def flops(self, h, w):
+        """Approximate FLOPs of one forward pass on an h x w input (before the block's own rescale)."""
+        macs = 0
+        for layer in [seq[0] for seq in self.conv0]:
+            m, h, w = conv_flops(layer, h, w)
+            macs += m
+        for block in [self.convblock0, self.convblock1, self.convblock2, self.convblock3]:
+            for seq in block:
+                m, h, w = conv_flops(seq[0], h, w)
+                macs += m
+        macs += conv_flops(self.conv1[0], h, w)[0] + conv_flops(self.conv2, h, w)[0]
+        return 2 * macs
         
 class IFNet(nn.Module):
     def __init__(self):
@@ -72,8 +98,25 @@ class IFNet(nn.Module):
         self.block_tea = IFBlock(10+4, c=90)
         # self.contextnet = Contextnet()
         # self.unet = Unet()
+        self.exit_stats = {'calls': 0, 'skips': [0, 0, 0], 'flops_total': 0, 'flops_saved': 0}
+        self.level_flops = {}
+
+    def record_exit(self, levels, h, w, scale_list):
+        """Accounts one adaptive forward pass that ran `levels` of the 3 cascade levels at working size h x w."""
+        key = (h, w, tuple(scale_list))
+        if key not in self.level_flops:
+            block = [self.block0, self.block1, self.block2]
+            # Each level runs its block twice (forward and reversed pair)
+            self.level_flops[key] = [2 * block[i].flops(int(h / scale_list[i]), int(w / scale_list[i])) for i in range(3)]
+        level_flops = self.level_flops[key]
+        stats = self.exit_stats
+        stats['calls'] += 1
+        stats['flops_total'] += sum(level_flops)
+        for i in range(levels, 3):
+            stats['skips'][i] += 1
+            stats['flops_saved'] += level_flops[i]
 
-    def forward(self, x, scale_list=[4, 2, 1], scale=1.0, training=False):
+    def forward(self, x, scale_list=[4, 2, 1], scale=1.0, training=False, exit_thresh=None):
         x = F.interpolate(x, scale_factor=scale, mode="bilinear", align_corners=False)
         if training == False:
             channel = x.shape[1] // 2
@@ -88,16 +131,31 @@ class IFNet(nn.Module):
         mask = torch.zeros_like(x[:, :1]).to(device)
         loss_cons = 0
         block = [self.block0, self.block1, self.block2]
+        levels = 3
         for i in range(3):
             f0, m0 = block[i](torch.cat((warped_img0[:, :3], warped_img1[:, :3], mask), 1), flow, scale=scale_list[i])
             f1, m1 = block[i](torch.cat((warped_img1[:, :3], warped_img0[:, :3], -mask), 1), torch.cat((flow[:, 2:4], flow[:, :2]), 1), scale=scale_list[i])
-            flow = flow + (f0 + torch.cat((f1[:, 2:4], f1[:, :2]), 1)) / 2
-            mask = mask + (m0 + (-m1)) / 2
+            flow_delta = (f0 + torch.cat((f1[:, 2:4], f1[:, :2]), 1)) / 2
+            mask_delta = (m0 + (-m1)) / 2
+            flow = flow + flow_delta
+            mask = mask + mask_delta
             mask_list.append(mask)
             flow_list.append(flow)
             warped_img0 = warp(img0, flow[:, :2])
             warped_img1 = warp(img1, flow[:, 2:4])
             merged.append((warped_img0, warped_img1))
+            if exit_thresh is not None and i < 2:
+                # Mean update of this level, flow in full-resolution pixels; one sync for both values
+                flow_upd, mask_upd = torch.stack((flow_delta.abs().mean() / scale, mask_delta.abs().mean())).tolist()
+                if flow_upd < exit_thresh[0] and mask_upd < exit_thresh[1]:
+                    levels = i + 1
+                    break
+        if exit_thresh is not None:
+            self.record_exit(levels, x.shape[2], x.shape[3], scale_list)
+        while len(merged) < 3:  # Skipped levels reuse the last refined estimate
+            flow_list.append(flow_list[-1])
+            mask_list.append(mask_list[-1])
+            merged.append(merged[-1])
         if scale != 1.0:
             flow = F.interpolate(flow, scale_factor=1 / scale, mode="bilinear", align_corners=False) / scale
             mask_list[2] = F.interpolate(mask_list[2], scale_factor=1 / scale, mode="bilinear", align_corners=False)
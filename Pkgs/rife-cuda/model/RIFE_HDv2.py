@@ -56,24 +56,24 @@ class ContextNet(nn.Module):
         self.conv3 = Conv2(2*c, 4*c)
         self.conv4 = Conv2(4*c, 8*c)
 
+    def features(self, x):
+        """Flow-independent feature pyramid of one image."""
+        x = self.conv1(self.conv0(x))
+        feats = [x]
+        for layer in [self.conv2, self.conv3, self.conv4]:
+            x = layer(x)
+            feats.append(x)
+        return feats
+
+    def warp_features(self, feats, flow):
+        out = []
+        for feat in feats:
+            flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear", align_corners=False) * 0.5
+            out.append(warp(feat.expand(flow.shape[0], -1, -1, -1), flow))
+        return out
+
     def forward(self, x, flow):
-        x = self.conv0(x)
-        x = self.conv1(x)
-        flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear", align_corners=False) * 0.5
-        f1 = warp(x, flow)
-        x = self.conv2(x)
-        flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear",
-                             align_corners=False) * 0.5
-        f2 = warp(x, flow)
-        x = self.conv3(x)
-        flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear",
-                             align_corners=False) * 0.5
-        f3 = warp(x, flow)
-        x = self.conv4(x)
-        flow = F.interpolate(flow, scale_factor=0.5, mode="bilinear",
-                             align_corners=False) * 0.5
-        f4 = warp(x, flow)
-        return [f1, f2, f3, f4]
+        return self.warp_features(self.features(x), flow)
 
 
 class FusionNet(nn.Module):
@@ -197,6 +197,29 @@ class Model:
         flow, _ = self.flownet(imgs, scale)
         return self.predict(imgs, flow, training=False)
 
+    def inference_multi(self, img0, img1, timesteps, scale=1.0, batch=8):
+        """Estimates bidirectional flow once and synthesizes all timesteps from linearly scaled copies of it, in batches."""
+        imgs = torch.cat((img0, img1), 1)
+        flow, _ = self.flownet(imgs, scale)
+        feats0 = self.contextnet.features(img0)
+        feats1 = self.contextnet.features(img1)
+        res = []
+        for i in range(0, len(timesteps), batch):
+            ts = torch.tensor(timesteps[i:i + batch], dtype=flow.dtype, device=flow.device).view(-1, 1, 1, 1)
+            n = ts.shape[0]
+            # Linear motion: F_t->0 = 2t * F_0.5->0 and F_t->1 = 2(1-t) * F_0.5->1
+            flow_t = torch.cat((2 * ts * flow[:, :2], 2 * (1 - ts) * flow[:, 2:4]), 1)
+            c0 = self.contextnet.warp_features(feats0, flow_t[:, :2])
+            c1 = self.contextnet.warp_features(feats1, flow_t[:, 2:4])
+            flow_t = F.interpolate(flow_t, scale_factor=2.0, mode="bilinear", align_corners=False) * 2.0
+            refine_output, warped_img0, warped_img1, _, _ = self.fusionnet(
+                img0.expand(n, -1, -1, -1), img1.expand(n, -1, -1, -1), flow_t, c0, c1, None)
+            res_img = torch.sigmoid(refine_output[:, :3]) * 2 - 1
+            mask = torch.sigmoid(refine_output[:, 3:4])
+            pred = torch.clamp(warped_img0 * mask + warped_img1 * (1 - mask) + res_img, 0, 1)
+            res.extend(pred.split(1))
+        return res
+
     def update(self, imgs, gt, learning_rate=0, mul=1, training=True, flow_gt=None):
         for param_group in self.optimG.param_groups:
             param_group['lr'] = learning_rate
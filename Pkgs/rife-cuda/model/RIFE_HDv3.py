@@ -52,12 +52,32 @@ class Model:
         if rank == 0:
             torch.save(self.flownet.state_dict(),'{}/flownet.pkl'.format(path))
 
-    def inference(self, img0, img1, scale=1.0):
+    def inference(self, img0, img1, scale=1.0, exit_thresh=None):
         imgs = torch.cat((img0, img1), 1)
         scale_list = [4, 2, 1]
-        flow, mask, merged = self.flownet(imgs, scale_list, scale=scale)
+        flow, mask, merged = self.flownet(imgs, scale_list, scale=scale, exit_thresh=exit_thresh)
         return merged[2]
     
+    def inference_multi(self, img0, img1, timesteps, scale=1.0, batch=8, exit_thresh=None):
+        """Estimates bidirectional flow and mask once, then warps and blends all timesteps in batches."""
+        imgs = torch.cat((img0, img1), 1)
+        flow_list, mask, merged = self.flownet(imgs, [4, 2, 1], scale=scale, exit_thresh=exit_thresh)
+        flow = flow_list[2]
+        if scale != 1.0:
+            flow = F.interpolate(flow, scale_factor=1 / scale, mode="bilinear", align_corners=False) / scale
+        res = []
+        for i in range(0, len(timesteps), batch):
+            ts = torch.tensor(timesteps[i:i + batch], dtype=flow.dtype, device=flow.device).view(-1, 1, 1, 1)
+            n = ts.shape[0]
+            # Linear motion: F_t->0 = 2t * F_0.5->0 and F_t->1 = 2(1-t) * F_0.5->1
+            warped_img0 = warp(img0.expand(n, -1, -1, -1), 2 * ts * flow[:, :2])
+            warped_img1 = warp(img1.expand(n, -1, -1, -1), 2 * (1 - ts) * flow[:, 2:4])
+            # Time-weighted blend, equal to merged[2] at t=0.5
+            w0 = (1 - ts) * mask
+            w1 = ts * (1 - mask)
+            res.extend(((warped_img0 * w0 + warped_img1 * w1) / (w0 + w1 + 1e-8)).split(1))
+        return res
+
     def update(self, imgs, gt, learning_rate=0, mul=1, training=True, flow_gt=None):
         for param_group in self.optimG.param_groups:
             param_group['lr'] = learning_rate
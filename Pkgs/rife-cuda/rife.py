@@ -7,9 +7,10 @@ import argparse
 import numpy as np
 from torch.nn import functional as F
 import warnings
-import _thread
 import skvideo.io
 from queue import Queue, Empty
+from collections import Counter
+from fractions import Fraction
 import shutil
 import base64
 warnings.filterwarnings("ignore")
@@ -20,28 +21,50 @@ print("Changing working dir to {0}".format(dname))
 os.chdir(os.path.dirname(dname))
 print("Added {0} to temporary PATH".format(dname))
 sys.path.append(dname)
+sys.path.append(os.path.join(os.path.dirname(dname), "common"))
+from ffcommon import buffers, framecodecs
+from ffcommon.frameindex import FrameIndex
+from ffcommon.pipeline import Pipeline
+from ffcommon.writer import FrameWriter
 
 
 parser = argparse.ArgumentParser(description='Interpolation for a pair of images')
 parser.add_argument('--input', dest='input', type=str, default=None)
 parser.add_argument('--output', required=False, default='frames-interpolated')
 parser.add_argument('--model', required=False, default='models')
-parser.add_argument('--imgformat', default="png")
-parser.add_argument('--rbuffer', dest='rbuffer', type=int, default=200)
-parser.add_argument('--wthreads', dest='wthreads', type=int, default=4)
+parser.add_argument('--imgformat', default="png", help='Output image format, or a fast intermediate codec: raw, lz4, zst, qoiv')
+parser.add_argument('--rbuffer', dest='rbuffer', type=int, default=200, help='Max frames per buffer, on top of the memory budget')
+parser.add_argument('--mem-budget', dest='mem_budget', type=float, default=0, help='Memory for read/write buffers in MB, 0 = half of available RAM')
+parser.add_argument('--wthreads', dest='wthreads', type=int, default=4, help='Max writer threads, the pool adapts below this')
+parser.add_argument('--pngcomp', dest='pngcomp', type=int, default=2, help='Base PNG compression level')
+parser.add_argument('--pngmax', dest='pngmax', type=int, default=4, help='Max PNG compression level when disk-bound')
 parser.add_argument('--fp16', dest='fp16', action='store_true', help='half-precision mode')
 parser.add_argument('--UHD', dest='UHD', action='store_true', help='support 4k video')
 parser.add_argument('--scale', dest='scale', type=float, default=1.0, help='Try scale=0.5 for 4k video')
+parser.add_argument('--autoscale', dest='autoscale', action='store_true', help='Pick scale per scene/window from estimated motion')
+parser.add_argument('--scalewindow', dest='scalewindow', type=int, default=30, help='Max frame pairs between --autoscale decisions')
 parser.add_argument('--exp', dest='exp', type=int, default=1)
 parser.add_argument('--multi', dest='multi', type=int, default=2)
+parser.add_argument('--infps', dest='infps', type=str, default=None, help='Source frame rate (e.g. 24000/1001), required for --timestamps/--outfps')
+parser.add_argument('--timestamps', dest='timestamps', type=str, default=None, help='File with one output timestamp (seconds from first frame) per line')
+parser.add_argument('--outfps', dest='outfps', type=str, default=None, help='Target frame rate (e.g. 60000/1001) to resample to instead of --multi')
+parser.add_argument('--maxdepth', dest='maxdepth', type=int, default=4, help='Midpoint recursion depth for timestamps on pre-v3.9 models')
+parser.add_argument('--flowonce', dest='flowonce', action='store_true', help='Pre-v3.9 models: estimate flow once per pair and synthesize all timesteps from it')
+parser.add_argument('--adaptive', dest='adaptive', type=float, default=0.0, help='Experimental, uncalibrated: v3 IFNet skips its remaining levels once a level changes the flow by less than '
+                    'this many full-resolution px on average over the frame (mean absolute update of all flow components, both '
+                    'directions). The first level\'s update is its whole coarse estimate. Small moving regions barely move '
+                    'the mean, so any value skips levels on mostly static frames whatever the quality cost. 0 = off')
+parser.add_argument('--passthrough', dest='passthrough', default='auto', choices=['auto', 'copy', 'off'], help='Source frames: hardlink/reflink/copy files (auto), reflink/copy only (copy) or re-encode (off)')
+parser.add_argument('--adaptive_mask', dest='adaptive_mask', type=float, default=0.05, help='Experimental: mean absolute update of the blend mask (pre-sigmoid) a level must also stay under for --adaptive')
 args = parser.parse_args()
 
 if args.exp != 1:
     args.multi = (2 ** args.exp)
     
 assert (not args.input is None)
+assert (args.timestamps is None and args.outfps is None) or args.infps is not None, "--timestamps/--outfps need --infps"
 
-if args.UHD and args.scale==1.0:
+if args.UHD and args.scale==1.0 and not args.autoscale:
     args.scale = 0.5
     
 assert args.scale in [0.25, 0.5, 1.0, 2.0, 4.0]
@@ -100,6 +123,19 @@ except:
 model.eval()
 model.device()
 
+infer_kwargs = {}
+if args.adaptive > 0:
+    if hasattr(model.flownet, 'exit_stats'):
+        infer_kwargs['exit_thresh'] = (args.adaptive, args.adaptive_mask)
+        print(f"Adaptive early exit enabled (flow < {args.adaptive}px, mask < {args.adaptive_mask}). EXPERIMENTAL: the thresholds "
+              f"are not calibrated against output quality, check the results against a run without --adaptive.")
+    else:
+        print("Adaptive early exit is not supported by this model architecture, running full cascade.")
+
+flow_once = args.flowonce and hasattr(model, 'inference_multi') and not (hasattr(model, 'version') and model.version >= 3.9)
+if flow_once:
+    print("Using flow-once synthesis for intermediate frames.")
+
 path = args.input
 name = os.path.basename(path)
 interp_output_path = (args.output).join(path.rsplit(name, 1))
@@ -107,102 +143,258 @@ print("interp_output_path: " + interp_output_path)
 
 cnt = 1
 
-videogen = []
-for f in os.listdir(args.input):
-    if 'png' in f or 'jpg' in f:
-        videogen.append(f)
-tot_frame = len(videogen)
-videogen.sort(key= lambda x:int(x[:-4]))
-img_path = os.path.join(args.input, videogen[0])
-lastframe = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)[:, :, ::-1].copy()
-videogen = videogen[1:]    
+# Absolute paths for passthrough, the writer resolves them independently of the working dir
+frame_index = FrameIndex(os.path.abspath(args.input))
+tot_frame = len(frame_index)
+lastframe = framecodecs.read(frame_index.path(0))[:, :, ::-1].copy()
 h, w, _ = lastframe.shape
 vid_out = None
 if not os.path.exists(interp_output_path):
     os.mkdir(interp_output_path)
     
 
-def clear_write_buffer(user_args, write_buffer, thread_id):
-    os.chdir(interp_output_path)
-    while True:
-        item = write_buffer.get()
-        if item is None:
-            break
-        frameNum = item[0]
-        img = item[1]
-        print('[T{}] => {:0>8d}.{}'.format(thread_id, frameNum, args.imgformat))
-        #imgBytes = base64.b64encode(cv2.imencode(f'.{args.imgformat}', img[:, :, ::-1], [cv2.IMWRITE_PNG_COMPRESSION, 2])[1].tostring())
-        #print(f"{frameNum:08}:"+ imgBytes.decode('utf-8') + "\n\n\n\n")
-        cv2.imwrite('{:0>8d}.{}'.format(frameNum, args.imgformat), img[:, :, ::-1], [cv2.IMWRITE_PNG_COMPRESSION, 2])
-
-def build_read_buffer(user_args, read_buffer, videogen):
-    for frame in videogen:
-        if not user_args.input is None:
-            img_path = os.path.join(user_args.input, frame)
-            frame = cv2.imdecode(np.fromfile(img_path, dtype=np.uint8), cv2.IMREAD_UNCHANGED)[:, :, ::-1].copy()
-        read_buffer.put(frame)
-    read_buffer.put(None)
-
-def make_inference(I0, I1, n):    
+def source_frame(idx, frame):
+    # Source frames can go to the writer as file paths when no re-encode is needed
+    if args.passthrough != 'off' and frame_index.ext(idx).lower() == args.imgformat.lower():
+        return frame_index.path(idx)
+    return frame
+
+def read_frames(paths):
+    for img_path in paths:
+        yield framecodecs.read(img_path)[:, :, ::-1].copy()
+
+def make_inference(I0, I1, n, scale):
     global model
     if hasattr(model, 'version') and model.version >= 3.9:
         res = []
         for i in range(n):
-            res.append(model.inference(I0, I1, (i+1) * 1. / (n+1), args.scale))
+            res.append(model.inference(I0, I1, (i+1) * 1. / (n+1), scale, **infer_kwargs))
         return res
+    elif flow_once:
+        return model.inference_multi(I0, I1, [(i+1) * 1. / (n+1) for i in range(n)], scale, **infer_kwargs)
     else:
-        middle = model.inference(I0, I1, args.scale)
+        middle = model.inference(I0, I1, scale, **infer_kwargs)
         if n == 1:
             return [middle]
-        first_half = make_inference(I0, middle, n=n//2)
-        second_half = make_inference(middle, I1, n=n//2)
+        first_half = make_inference(I0, middle, n//2, scale)
+        second_half = make_inference(middle, I1, n//2, scale)
         if n%2:
             return [*first_half, middle, *second_half]
         else:
             return [*first_half, *second_half]
     
-def pad_image(img):
-    if(args.fp16):
-        return F.pad(img, padding).half()
+pad_buffers = {}
+
+def pad_image(img, scale):
+    # Frames are copied into two preallocated zero-padded buffers per padded size, used alternately for I0/I1
+    tmp = max(128, int(128 / scale))
+    ph = ((h - 1) // tmp + 1) * tmp
+    pw = ((w - 1) // tmp + 1) * tmp
+    if (ph, pw) not in pad_buffers:
+        dtype = torch.half if args.fp16 else torch.float
+        pad_buffers[(ph, pw)] = [[torch.zeros((1, img.shape[1], ph, pw), dtype=dtype, device=device) for _ in range(2)], 0]
+    bufs = pad_buffers[(ph, pw)]
+    bufs[1] ^= 1
+    buf = bufs[0][bufs[1]]
+    buf[:, :, :h, :w].copy_(img[:, :, :h, :w])
+    return buf
+
+def estimate_motion(img0, img1):
+    # Farneback flow on a small grey pair: 95th percentile magnitude in full-res pixels, plus mean abs difference
+    f = min(1.0, 256 / max(h, w))
+    small = [cv2.cvtColor(cv2.resize(np.ascontiguousarray(img[:, :, :3]), None, fx=f, fy=f, interpolation=cv2.INTER_AREA), cv2.COLOR_RGB2GRAY) for img in (img0, img1)]
+    flow = cv2.calcOpticalFlowFarneback(small[0], small[1], None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    motion = np.percentile(np.sqrt((flow ** 2).sum(2)), 95) / f
+    return motion, np.abs(small[0].astype(np.float32) - small[1]).mean()
+
+def pick_scale(motion):
+    base = 1.0 if h * w <= 2560 * 1440 else 0.5
+    rel_motion = motion / max(h, w)
+    if rel_motion < 0.005:
+        return base / 2
+    if rel_motion > 0.03:
+        return min(base * 2, 1.0)
+    return base
+
+autoscale_state = {'pairs': 0, 'scale': args.scale}
+
+def update_scale(img0, img1):
+    # Re-decide at window boundaries and scene cuts only, so the estimate costs ~1 small flow per window
+    state = autoscale_state
+    if state['pairs'] % args.scalewindow == 0:
+        state['scale'] = pick_scale(estimate_motion(img0, img1)[0])
+    else:
+        f = min(1.0, 64 / max(h, w))
+        diff = np.abs(cv2.resize(img0[:, :, :3], None, fx=f, fy=f, interpolation=cv2.INTER_AREA).astype(np.float32) - cv2.resize(img1[:, :, :3], None, fx=f, fy=f, interpolation=cv2.INTER_AREA)).mean()
+        if diff > 30:
+            state['pairs'] = 0
+            state['scale'] = pick_scale(estimate_motion(img0, img1)[0])
+    state['pairs'] += 1
+    return state['scale']
+
+if args.autoscale:
+    print("Using automatic scale.")
+else:
+    print(f"Using scale {args.scale}.")
+scale = args.scale
+scale_counts = Counter()
+
+# The write side gets the larger share since it receives multi-1 new frames for every frame read
+mem_budget = buffers.memory_budget(args.mem_budget)
+pipe = Pipeline()
+read_buffer = pipe.queue(mem_budget // 3, args.rbuffer, name='Read buffer')
+write_buffer = pipe.queue(mem_budget - mem_budget // 3, args.rbuffer, name='Write buffer')
+print(f"Buffer memory budget: {mem_budget / 1024 ** 2:.0f} MB, up to {min(read_buffer.max_bytes // lastframe.nbytes, args.rbuffer)} read / {min(write_buffer.max_bytes // lastframe.nbytes, args.rbuffer)} write frames at {w}x{h}")
+pipe.source(read_buffer, read_frames(frame_index.paths(1)), name='reader')
+
+writer = FrameWriter(pipe, write_buffer, interp_output_path, args.imgformat, args.wthreads, args.pngcomp, args.pngmax, rgb=True, passthrough=args.passthrough)
+
+def to_tensor(img, scale):
+    img = torch.from_numpy(np.transpose(img, (2,0,1))).to(device, non_blocking=True).unsqueeze(0).float() / 255.
+    return pad_image(img, scale)
+
+def to_frame(img):
+    # Crop the padding before the download so queued frames don't keep the padded buffer alive
+    return (img[0, :, :h, :w] * 255.).byte().cpu().numpy().transpose(1, 2, 0)
+
+def run_multi():
+    global cnt, lastframe, scale
+    I1 = to_tensor(lastframe, scale)
+    frame_idx = 0
+    for frame in pipe.drain(read_buffer):
+        if args.autoscale:
+            new_scale = update_scale(lastframe, frame)
+            if new_scale != scale:
+                scale = new_scale
+                I1 = pad_image(I1, scale)
+        scale_counts[scale] += 1
+        I0 = I1
+        I1 = to_tensor(frame, scale)
+
+        output = make_inference(I0, I1, args.multi-1, scale)
+        write_buffer.put([cnt, source_frame(frame_idx, lastframe)])
+        cnt += 1
+        for mid in output:
+            # print(f"Adding #{cnt} to buffer.")
+            write_buffer.put([cnt, to_frame(mid)])
+            cnt += 1
+
+        lastframe = frame
+        frame_idx += 1
+    write_buffer.put([cnt, source_frame(frame_idx, lastframe)])
+
+def load_positions():
+    # Output timestamps as exact positions in source frame units, snapped onto source frames when within 1/1000 frame
+    infps = Fraction(args.infps)
+    if args.timestamps is not None:
+        with open(args.timestamps) as f:
+            positions = [Fraction(line.strip()) * infps for line in f if line.strip()]
     else:
-        return F.pad(img, padding)
-
-print(f"Using scale {args.scale}.")
-tmp = max(128, int(128 / args.scale))
-ph = ((h - 1) // tmp + 1) * tmp
-pw = ((w - 1) // tmp + 1) * tmp
-padding = (0, pw - w, 0, ph - h)
-
-write_buffer = Queue(maxsize=args.rbuffer)
-read_buffer = Queue(maxsize=args.rbuffer)
-_thread.start_new_thread(build_read_buffer, (args, read_buffer, videogen))
-
-for x in range(args.wthreads):
-    _thread.start_new_thread(clear_write_buffer, (args, write_buffer, x))
-
-I1 = torch.from_numpy(np.transpose(lastframe, (2,0,1))).to(device, non_blocking=True).unsqueeze(0).float() / 255.
-I1 = pad_image(I1)
-
-while True:
-    frame = read_buffer.get()
-    if frame is None:
-        break
-    I0 = I1
-    I1 = torch.from_numpy(np.transpose(frame, (2,0,1))).to(device, non_blocking=True).unsqueeze(0).float() / 255.
-    I1 = pad_image(I1)
-
-    output = make_inference(I0, I1, args.multi-1)
-    write_buffer.put([cnt, lastframe])
-    cnt += 1
-    for mid in output:
-        mid = (((mid[0] * 255.).byte().cpu().numpy().transpose(1, 2, 0)))
-        # print(f"Adding #{cnt} to buffer.")
-        write_buffer.put([cnt, mid[:h, :w]])
+        step = infps / Fraction(args.outfps)
+        positions = [k * step for k in range(int((tot_frame - 1) / step) + 1)]
+    positions = [Fraction(round(p)) if abs(p - round(p)) < Fraction(1, 1000) else p for p in positions]
+    dropped = [p for p in positions if p < 0 or p > tot_frame - 1]
+    if dropped:
+        print(f"Ignoring {len(dropped)} timestamps outside of the input frame range.")
+    return sorted(p for p in positions if 0 <= p <= tot_frame - 1)
+
+ts_stats = Counter()
+
+def quantize_t(t):
+    # Pre-v3.9 models can only produce recursive midpoints, so use the nearest one within --maxdepth
+    if (hasattr(model, 'version') and model.version >= 3.9) or flow_once:
+        return t
+    return Fraction(round(t * 2 ** args.maxdepth), 2 ** args.maxdepth)
+
+def infer_timesteps(I0, I1, ts, scale):
+    if hasattr(model, 'version') and model.version >= 3.9:
+        ts_stats['model_runs'] += len(ts)
+        return {t: model.inference(I0, I1, float(t), scale, **infer_kwargs) for t in ts}
+    if flow_once:
+        ts_stats['model_runs'] += 1
+        return dict(zip(ts, model.inference_multi(I0, I1, [float(t) for t in ts], scale, **infer_kwargs)))
+    cache = {Fraction(0): I0, Fraction(1): I1}
+    for t in ts:
+        lo, hi = Fraction(0), Fraction(1)
+        while True:
+            mid = (lo + hi) / 2
+            if mid not in cache:
+                cache[mid] = model.inference(cache[lo], cache[hi], scale, **infer_kwargs)
+                ts_stats['model_runs'] += 1
+            if t == mid:
+                break
+            lo, hi = (lo, mid) if t < mid else (mid, hi)
+    return cache
+
+def run_timestamps():
+    global cnt, lastframe, scale
+    positions = load_positions()
+    print(f"Rendering {len(positions)} output frames from {tot_frame} input frames.")
+    pos_idx = 0
+    frame_idx = 0
+    I1, I1_idx, I1_scale = None, -1, None
+    for frame in pipe.drain(read_buffer):
+        ts = []
+        while pos_idx < len(positions) and positions[pos_idx] < frame_idx + 1:
+            ts.append(quantize_t(positions[pos_idx] - frame_idx))
+            pos_idx += 1
+        new_ts = sorted(set(t for t in ts if 0 < t < 1))
+        if new_ts:
+            if args.autoscale:
+                scale = update_scale(lastframe, frame)
+            scale_counts[scale] += 1
+            # Only upload frames for pairs that need inference, reusing I1 when the previous pair did too
+            if I1_idx == frame_idx:
+                I0 = I1 if I1_scale == scale else pad_image(I1, scale)
+            else:
+                I0 = to_tensor(lastframe, scale)
+            I1, I1_idx, I1_scale = to_tensor(frame, scale), frame_idx + 1, scale
+            results = infer_timesteps(I0, I1, new_ts, scale)
+        else:
+            ts_stats['pairs_skipped'] += 1
+        for t in ts:
+            if t == 0 or t == 1:
+                write_buffer.put([cnt, source_frame(frame_idx, lastframe) if t == 0 else source_frame(frame_idx + 1, frame)])
+                ts_stats['copies'] += 1
+            else:
+                write_buffer.put([cnt, to_frame(results[t])])
+                ts_stats['rendered'] += 1
+            cnt += 1
+        lastframe = frame
+        frame_idx += 1
+    while pos_idx < len(positions):
+        write_buffer.put([cnt, source_frame(frame_idx, lastframe)])
+        ts_stats['copies'] += 1
+        pos_idx += 1
         cnt += 1
 
-    lastframe = frame
-write_buffer.put([cnt, lastframe])
-import time
-while(not write_buffer.empty()):
-    time.sleep(0.5)
-time.sleep(0.5)
+with pipe:
+    if args.timestamps is not None or args.outfps is not None:
+        run_timestamps()
+    else:
+        run_multi()
+    pipe.close(write_buffer)
+
+def print_run_stats():
+    lines = [read_buffer.stats(), write_buffer.stats()]
+    if 'exit_thresh' in infer_kwargs:
+        stats = model.flownet.exit_stats
+        calls = max(stats['calls'], 1)
+        for level in range(1, 3):
+            lines.append(f"Adaptive exit: level {level} skipped in {stats['skips'][level] / calls * 100:.1f}% of {stats['calls']} passes")
+        saved_pct = stats['flops_saved'] / max(stats['flops_total'], 1) * 100
+        lines.append(f"Adaptive exit: ~{stats['flops_saved'] / 1e9:.1f} of {stats['flops_total'] / 1e9:.1f} IFNet GFLOPs saved ({saved_pct:.1f}%), "
+                     f"quality cost not measured")
+    if args.autoscale:
+        pairs = max(sum(scale_counts.values()), 1)
+        dist = ", ".join(f"{s}: {n / pairs * 100:.1f}% ({n})" for s, n in sorted(scale_counts.items()))
+        lines.append(f"Scale distribution: {dist}")
+    if args.timestamps is not None or args.outfps is not None:
+        lines.append(f"Timestamps: {ts_stats['rendered']} interpolated, {ts_stats['copies']} source copies, {ts_stats['model_runs']} model runs, {ts_stats['pairs_skipped']} pairs without inference")
+    lines += writer.stats()
+    if lines:
+        print("Run stats:")
+        for line in lines:
+            print("  " + line)
+
+print_run_stats()
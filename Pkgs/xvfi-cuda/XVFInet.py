@@ -1,4 +1,5 @@
 import functools, random
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -31,6 +32,7 @@ class XVFInet(nn.Module):
 		self.rec_ext_ds_module = nn.Sequential(*self.rec_ext_ds_module)
 
 		self.rec_ctx_ds = nn.Conv3d(self.nf, self.nf, [1, 3, 3], [1, 2, 2], [0, 1, 1])
+		self.feat_cache = None # (frame key, test pyramid of that frame), see forward_multi
 
 		print("The lowest scale depth for training (S_trn): ", self.args.S_trn)
 		print("The lowest scale depth for test (S_tst): ", self.args.S_tst)
@@ -74,6 +76,54 @@ class XVFInet(nn.Module):
 			out_l = self.vfinet(x, feat_x_list[0], flow_l, t_value, level=0, is_training=False)
 			return out_l
 
+	def feature_pyramid(self, x, levels=None):
+		'''
+		Test pyramid, levels 0 to levels (default S_tst). All kernels are [1,3,3], so each frame's features depend on that frame only.
+		x shape : [B,C,T,H,W]
+		'''
+		levels = self.args.S_tst if levels is None else levels
+		feat_x = self.rec_ext_ds_module(x)
+		feat_x_list = [feat_x]
+		for level in range(1, levels+1):
+			feat_x = self.rec_ctx_ds(feat_x)
+			feat_x_list.append(feat_x)
+		return feat_x_list
+
+	def forward_multi(self, x, t_values, t_batch=0, keys=None, levels=None):
+		'''
+		Test only. Interpolates every t of one pair: the feature pyramid and the flows of all levels (level 0
+		included) do not depend on t and are computed once, then the level 0 synthesis runs batched over t.
+		x shape : [1,C,T,H,W]
+		t_values shape : [K,1]
+		t_batch : max t per synthesis batch, 0 = all K at once
+		keys : optional (I0 key, I1 key). I1's pyramid is kept, and reused when the next pair's I0 has the same key
+		levels : lowest scale depth, default S_tst. H and W must be multiples of 2**levels * module_scale_factor * 4
+		returns : [K,C,H,W]
+		'''
+		levels = self.args.S_tst if levels is None else levels
+		if keys is not None and self.feat_cache is not None and self.feat_cache[0] == keys[0] and len(self.feat_cache[1]) == levels+1:
+			feat1_list = self.feature_pyramid(x[:, :, 1:2], levels)
+			feat_x_list = [torch.cat([feat0, feat1], dim=2) for feat0, feat1 in zip(self.feat_cache[1], feat1_list)]
+		else:
+			feat_x_list = self.feature_pyramid(x, levels)
+			feat1_list = [feat_x[:, :, 1:2].clone() for feat_x in feat_x_list]
+		self.feat_cache = None if keys is None else (keys[1], feat1_list) # Bounded to a single frame's pyramid
+
+		flow_l = None
+		for level in range(levels, 0, -1):
+			flow_l, _ = self.vfinet.estimate_flow(feat_x_list[level], flow_l)
+		flow_l, flow_l_tmp = self.vfinet.estimate_flow(feat_x_list[0], flow_l)
+
+		K = t_values.size(0)
+		t_batch = t_batch or K
+		out = []
+		for start in range(0, K, t_batch):
+			t_value = t_values[start:start+t_batch]
+			n = t_value.size(0)
+			out.append(self.vfinet.synthesize(x.expand(n, -1, -1, -1, -1), feat_x_list[0].expand(n, -1, -1, -1, -1),
+											  flow_l.expand(n, -1, -1, -1), flow_l_tmp.expand(n, -1, -1, -1), t_value.view(n, 1, 1, 1))[0])
+		return torch.cat(out, dim=0)
+
 
 class VFInet(nn.Module):
 	
@@ -133,6 +183,7 @@ class VFInet(nn.Module):
 		
 		self.refine_unet = RefineUNet(args)
 		self.lrelu = nn.ReLU()
+		self.grid_cache = OrderedDict() # Per-shape index grids for bwarp and splat, see base_grid and splat_base
 
 	def forward(self, x, feat_x, flow_l_prev, t_value, level, is_training):
 		'''
@@ -159,11 +210,35 @@ class VFInet(nn.Module):
 
 		B, C, T, H, W = x_l.size()
 
-		## Feature extraction
+		## Flow estimation
+		flow_l, flow_l_tmp = self.estimate_flow(feat_x, flow_l_prev)
+		
+		if not is_training and level!=0: 
+			return flow_l 
+
+		out_l, flow_refine_l, occ_0_l = self.synthesize(x_l, feat_x, flow_l, flow_l_tmp, t_value)
+
+		if not is_training and level==0: 
+			return out_l
+
+		if is_training: 
+			if flow_l_prev is None:
+			# if level == self.args.S_trn:
+				return out_l, flow_l, flow_refine_l[:, 0:4, :, :]
+			elif level != 0:
+				return out_l, flow_l
+			else: # level==0
+				return out_l, flow_l, flow_refine_l[:, 0:4, :, :], occ_0_l
+
+	def estimate_flow(self, feat_x, flow_l_prev):
+		'''
+		Bidirectional flow of one level, independent of t.
+		feat_x shape : [B,nf,T,H,W]
+		returns flow_l [B,4,H,W] and the raw conv output flow_l_tmp [B,6,H,W] (occlusion logits in channels 4-5)
+		'''
 		feat0_l = feat_x[:,:,0,:,:]
 		feat1_l = feat_x[:,:,1,:,:]
 
-		## Flow estimation
 		if flow_l_prev is None:
 			flow_l_tmp = self.conv_flow_bottom(torch.cat((feat0_l, feat1_l), dim=1))
 			flow_l = flow_l_tmp[:,:4,:,:]
@@ -173,10 +248,17 @@ class VFInet(nn.Module):
 			warped_feat0_l = self.bwarp(feat0_l, up_flow_l_prev[:,2:,:,:])
 			flow_l_tmp = self.conv_flow2(torch.cat([self.conv_flow1(torch.cat([feat0_l, warped_feat1_l],dim=1)), self.conv_flow1(torch.cat([feat1_l, warped_feat0_l],dim=1)), up_flow_l_prev],dim=1))
 			flow_l = flow_l_tmp[:,:4,:,:] + up_flow_l_prev
-		
-		if not is_training and level!=0: 
-			return flow_l 
-		
+		return flow_l, flow_l_tmp
+
+	def synthesize(self, x_l, feat_x, flow_l, flow_l_tmp, t_value):
+		'''
+		Frame at t from the level's flows (CFR, flow refinement, warping and blending).
+		x_l shape : [B,C,T,H,W] at this level, t_value shape : [B,1,1,1]
+		returns out_l, flow_refine_l, occ_0_l
+		'''
+		feat0_l = feat_x[:,:,0,:,:]
+		feat1_l = feat_x[:,:,1,:,:]
+
 		flow_01_l = flow_l[:,:2,:,:]
 		flow_10_l = flow_l[:,2:,:,:]
 		z_01_l = torch.sigmoid(flow_l_tmp[:,4:5,:,:])
@@ -190,7 +272,7 @@ class VFInet(nn.Module):
 		flow_t1_l = (1-t_value) * ((1-t_value)*flow_forward) - (t_value) * ((1-t_value)*flow_backward) # The numerator of Eq.(2) in the paper.
 		
 		norm_l = (1-t_value)*norm0_l + t_value*norm1_l
-		mask_ = (norm_l.detach() > 0).type(norm_l.type())
+		mask_ = (norm_l.detach() > 0).to(norm_l.dtype)
 		flow_t0_l = (1-mask_) * flow_t0_l + mask_ * (flow_t0_l.clone() / (norm_l.clone() + (1-mask_))) # Divide the numerator with denominator in Eq.(1)
 		flow_t1_l = (1-mask_) * flow_t1_l + mask_ * (flow_t1_l.clone() / (norm_l.clone() + (1-mask_))) # Divide the numerator with denominator in Eq.(2)
 
@@ -221,18 +303,23 @@ class VFInet(nn.Module):
 		
 		out_l = (1-t_value)*occ_0_l*warped_img0_l + t_value*occ_1_l*warped_img1_l
 		out_l = out_l / ( (1-t_value)*occ_0_l + t_value*occ_1_l ) + refine_out[:, 1:4, :, :]
-
-		if not is_training and level==0: 
-			return out_l
-
-		if is_training: 
-			if flow_l_prev is None:
-			# if level == self.args.S_trn:
-				return out_l, flow_l, flow_refine_l[:, 0:4, :, :]
-			elif level != 0:
-				return out_l, flow_l
-			else: # level==0
-				return out_l, flow_l, flow_refine_l[:, 0:4, :, :], occ_0_l
+		return out_l, flow_refine_l, occ_0_l
+
+	def base_grid(self, H, W, device):
+		# Pixel coordinates [1,2,H,W] (x, y), shared by every bwarp at this size. A handful of sizes occur per run
+		# (one per pyramid level and the upscaled level 0), so the cache is bounded to 16 entries
+		key = (H, W, device)
+		grid = self.grid_cache.get(key)
+		if grid is None:
+			xx = torch.arange(0, W, device=device, dtype=torch.float32).view(1, 1, 1, W).expand(1, 1, H, W)
+			yy = torch.arange(0, H, device=device, dtype=torch.float32).view(1, 1, H, 1).expand(1, 1, H, W)
+			grid = torch.cat((xx, yy), 1)
+			self.grid_cache[key] = grid
+			if len(self.grid_cache) > 16:
+				self.grid_cache.popitem(last=False)
+		else:
+			self.grid_cache.move_to_end(key)
+		return grid
 
 	def bwarp(self, x, flo):
 		'''
@@ -240,28 +327,20 @@ class VFInet(nn.Module):
 		flo: [B, 2, H, W] flow
 		'''
 		B, C, H, W = x.size()
-		# mesh grid
-		xx = torch.arange(0, W).view(1, 1, 1, W).expand(B, 1, H, W)
-		yy = torch.arange(0, H).view(1, 1, H, 1).expand(B, 1, H, W)
-		grid = torch.cat((xx, yy), 1).float()
-
-		if x.is_cuda:
-			grid = grid.to(self.device)
-		vgrid = torch.autograd.Variable(grid) + flo
+		vgrid = self.base_grid(H, W, flo.device) + flo # [B,2,H,W] sampling positions in pixels
 
 		# scale grid to [-1,1]
-		vgrid[:, 0, :, :] = 2.0 * vgrid[:, 0, :, :].clone() / max(W - 1, 1) - 1.0
-		vgrid[:, 1, :, :] = 2.0 * vgrid[:, 1, :, :].clone() / max(H - 1, 1) - 1.0
-
-		vgrid = vgrid.permute(0, 2, 3, 1)  # [B,H,W,2]
-		output = nn.functional.grid_sample(x, vgrid, align_corners=True)
-		mask = torch.autograd.Variable(torch.ones(x.size())).to(self.device)
-		mask = nn.functional.grid_sample(mask, vgrid, align_corners=True)
-
-		# mask[mask<0.9999] = 0
-		# mask[mask>0] = 1
-		mask = mask.masked_fill_(mask < 0.999, 0)
-		mask = mask.masked_fill_(mask > 0, 1)
+		scale = vgrid.new_tensor([2.0 / max(W - 1, 1), 2.0 / max(H - 1, 1)]).view(1, 2, 1, 1)
+		output = nn.functional.grid_sample(x, (vgrid * scale - 1.0).permute(0, 2, 3, 1), align_corners=True)
+
+		# Validity mask, computed from the positions instead of a second grid_sample over a tensor of ones: that
+		# sample equals the bilinear weight of the in-bounds taps, which is separable into x and y. Pixels where
+		# it is < 0.999 (partly outside the frame) are masked out as before
+		pos0 = torch.floor(vgrid)
+		frac = vgrid - pos0
+		upper = vgrid.new_tensor([W - 1, H - 1]).view(1, 2, 1, 1)
+		inside = (1 - frac) * ((pos0 >= 0) & (pos0 <= upper)) + frac * ((pos0 >= -1) & (pos0 <= upper - 1))
+		mask = (inside[:, 0:1] * inside[:, 1:2] >= 0.999).to(output.dtype)
 
 		return output * mask
 
@@ -274,46 +353,7 @@ class VFInet(nn.Module):
 			https://github.com/lyh-18/EQVI/blob/EQVI-master/models/forward_warp_gaussian.py
 		"""
 
-		# (x1, y1)		(x1, y2)
-		# +---------------+
-		# |				  |
-		# |	o(x, y) 	  |
-		# |				  |
-		# |				  |
-		# |				  |
-		# |				  |
-		# +---------------+
-		# (x2, y1)		(x2, y2)
-
-		N, C, _, _ = img.size()
-
-		# translate start-point optical flow to end-point optical flow
-		y = flo[:, 0:1:, :]
-		x = flo[:, 1:2, :, :]
-
-		x = x.repeat(1, C, 1, 1)
-		y = y.repeat(1, C, 1, 1)
-
-		# Four point of square (x1, y1), (x1, y2), (x2, y1), (y2, y2)
-		x1 = torch.floor(x)
-		x2 = x1 + 1
-		y1 = torch.floor(y)
-		y2 = y1 + 1
-
-		# firstly, get gaussian weights
-		w11, w12, w21, w22 = self.get_gaussian_weights(x, y, x1, x2, y1, y2)
-
-		# secondly, sample each weighted corner
-		img11, o11 = self.sample_one(img, x1, y1, w11)
-		img12, o12 = self.sample_one(img, x1, y2, w12)
-		img21, o21 = self.sample_one(img, x2, y1, w21)
-		img22, o22 = self.sample_one(img, x2, y2, w22)
-
-		imgw = img11 + img12 + img21 + img22
-		o = o11 + o12 + o21 + o22
-
-		return imgw, o
-
+		return self.splat(img, flo, 1.0)
 
 	def z_fwarp(self, img, flo, z):
 		"""
@@ -323,94 +363,64 @@ class VFInet(nn.Module):
 			modified from https://github.com/lyh-18/EQVI/blob/EQVI-master/models/forward_warp_gaussian.py
 		"""
 
-		# (x1, y1)		(x1, y2)
-		# +---------------+
-		# |				  |
-		# |	o(x, y) 	  |
-		# |				  |
-		# |				  |
-		# |				  |
-		# |				  |
-		# +---------------+
-		# (x2, y1)		(x2, y2)
-
-		N, C, _, _ = img.size()
-
-		# translate start-point optical flow to end-point optical flow
-		y = flo[:, 0:1:, :]
-		x = flo[:, 1:2, :, :]
-
-		x = x.repeat(1, C, 1, 1)
-		y = y.repeat(1, C, 1, 1)
-
-		# Four point of square (x1, y1), (x1, y2), (x2, y1), (y2, y2)
-		x1 = torch.floor(x)
-		x2 = x1 + 1
-		y1 = torch.floor(y)
-		y2 = y1 + 1
-
-		# firstly, get gaussian weights
-		w11, w12, w21, w22 = self.get_gaussian_weights(x, y, x1, x2, y1, y2, z+1e-5)
-
-		# secondly, sample each weighted corner
-		img11, o11 = self.sample_one(img, x1, y1, w11)
-		img12, o12 = self.sample_one(img, x1, y2, w12)
-		img21, o21 = self.sample_one(img, x2, y1, w21)
-		img22, o22 = self.sample_one(img, x2, y2, w22)
-
-		imgw = img11 + img12 + img21 + img22
-		o = o11 + o12 + o21 + o22
-
-		return imgw, o
-
-
-	def get_gaussian_weights(self, x, y, x1, x2, y1, y2, z=1.0):
-		# z 0.0 ~ 1.0
-		w11 = z * torch.exp(-((x - x1) ** 2 + (y - y1) ** 2))
-		w12 = z * torch.exp(-((x - x1) ** 2 + (y - y2) ** 2))
-		w21 = z * torch.exp(-((x - x2) ** 2 + (y - y1) ** 2))
-		w22 = z * torch.exp(-((x - x2) ** 2 + (y - y2) ** 2))
-
-		return w11, w12, w21, w22
+		return self.splat(img, flo, z+1e-5)
+
+	def splat_base(self, N, H, W, device):
+		# Row [1,H,1] and column [1,1,W] indices and the flat offset of each batch item [N,1,1], shared per shape
+		key = ('splat', N, H, W, device)
+		base = self.grid_cache.get(key)
+		if base is None:
+			base = (torch.arange(H, device=device).view(1, H, 1), torch.arange(W, device=device).view(1, 1, W),
+					torch.arange(N, device=device).view(N, 1, 1) * (H * W))
+			self.grid_cache[key] = base
+			if len(self.grid_cache) > 16:
+				self.grid_cache.popitem(last=False)
+		else:
+			self.grid_cache.move_to_end(key)
+		return base
 
-	def sample_one(self, img, shiftx, shifty, weight):
+	def splat(self, img, flo, z):
 		"""
-		Input:
+		Gaussian-weighted forward warp: every source pixel is splatted onto the four integer pixels around its
+		target (floor/floor+1 in each direction) with weight z * exp(-squared distance).
 			-img (N, C, H, W)
-			-shiftx, shifty (N, c, H, W)
+			-flo (N, 2, H, W), channel 0 shifts columns and channel 1 shifts rows
+			-z scalar or (N, 1, H, W)
+		Returns the splatted img and the summed weights, both (N, C, H, W).
+		The four corners of all pixels go through one index_add_ over a flat [C+1, N*H*W] buffer, with the
+		weights as the extra row; positions are computed once per pixel and broadcast over the channels.
 		"""
-
 		N, C, H, W = img.size()
-
-		# flatten all (all restored as Tensors)
-		flat_shiftx = shiftx.view(-1)
-		flat_shifty = shifty.view(-1)
-		flat_basex = torch.arange(0, H, requires_grad=False).view(-1, 1)[None, None].to(self.device).long().repeat(N, C,1,W).view(-1)
-		flat_basey = torch.arange(0, W, requires_grad=False).view(1, -1)[None, None].to(self.device).long().repeat(N, C,H,1).view(-1)
-		flat_weight = weight.view(-1)
-		flat_img = img.contiguous().view(-1)
-
-		# The corresponding positions in I1
-		idxn = torch.arange(0, N, requires_grad=False).view(N, 1, 1, 1).to(self.device).long().repeat(1, C, H, W).view(-1)
-		idxc = torch.arange(0, C, requires_grad=False).view(1, C, 1, 1).to(self.device).long().repeat(N, 1, H, W).view(-1)
-		idxx = flat_shiftx.long() + flat_basex
-		idxy = flat_shifty.long() + flat_basey
-
-		# recording the inside part the shifted
-		mask = idxx.ge(0) & idxx.lt(H) & idxy.ge(0) & idxy.lt(W)
-
-		# Mask off points out of boundaries
-		ids = (idxn * C * H * W + idxc * H * W + idxx * W + idxy)
-		ids_mask = torch.masked_select(ids, mask).clone().to(self.device)
-
-		# Note here! accmulate fla must be true for proper bp
-		img_warp = torch.zeros([N * C * H * W, ]).to(self.device)
-		img_warp.put_(ids_mask, torch.masked_select(flat_img * flat_weight, mask), accumulate=True)
-
-		one_warp = torch.zeros([N * C * H * W, ]).to(self.device)
-		one_warp.put_(ids_mask, torch.masked_select(flat_weight, mask), accumulate=True)
-
-		return img_warp.view(N, C, H, W), one_warp.view(N, C, H, W)
+		col = flo[:, 0]
+		row = flo[:, 1]
+		row0 = torch.floor(row)
+		col0 = torch.floor(col)
+		drow = row - row0
+		dcol = col - col0
+		base_row, base_col, base_n = self.splat_base(N, H, W, img.device)
+		row0 = row0.long() + base_row
+		col0 = col0.long() + base_col
+		z = z.view(N, H, W) if torch.is_tensor(z) else z
+
+		# Corners in the order (row0, col0), (row0, col0+1), (row0+1, col0), (row0+1, col0+1)
+		rows = torch.stack([row0, row0, row0 + 1, row0 + 1])
+		cols = torch.stack([col0, col0 + 1, col0, col0 + 1])
+		drows = torch.stack([drow, drow, drow - 1, drow - 1])
+		dcols = torch.stack([dcol, dcol - 1, dcol, dcol - 1])
+		weight = z * torch.exp(-(drows ** 2 + dcols ** 2)) # [4,N,H,W]
+
+		# Targets outside the frame go to an extra slot at the end that is dropped
+		inside = (rows >= 0) & (rows < H) & (cols >= 0) & (cols < W)
+		index = (base_n + rows * W + cols).masked_fill_(~inside, N * H * W).view(-1)
+
+		src = img.permute(1, 0, 2, 3).reshape(C, 1, N * H * W)
+		values = torch.cat([(src * weight.view(1, 4, N * H * W)).view(C, -1), weight.view(1, -1)], dim=0)
+		out = torch.zeros(C + 1, N * H * W + 1, device=img.device, dtype=values.dtype)
+		out.index_add_(1, index, values)
+
+		imgw = out[:C, :-1].view(C, N, H, W).permute(1, 0, 2, 3)
+		o = out[C:, :-1].view(1, N, H, W).permute(1, 0, 2, 3).expand(N, C, H, W)
+		return imgw, o
 
 class RefineUNet(nn.Module):
 	def __init__(self, args):
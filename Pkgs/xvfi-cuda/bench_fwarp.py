@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import argparse
+import torch
+
+# Times VFInet.z_fwarp against the previous implementation (four sample_one calls, each rebuilding N*C*H*W index
+# tensors and doing masked put_ with accumulate) and checks both give the same result.
+
+dname = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(dname)
+from XVFInet import VFInet
+
+parser = argparse.ArgumentParser(description='Benchmark XVFI forward warping')
+parser.add_argument('--size', type=int, nargs=2, default=[270, 480], help='H W of the warped flow')
+parser.add_argument('--channels', type=int, default=2, help='2 = flow reversal as used by the model')
+parser.add_argument('--batch', type=int, default=1)
+parser.add_argument('--flow', type=float, default=20.0, help='Max flow magnitude in pixels')
+parser.add_argument('--iters', type=int, default=10)
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+torch.set_grad_enabled(False)
+
+def sample_one_reference(img, shiftx, shifty, weight):
+    N, C, H, W = img.size()
+    flat_shiftx = shiftx.view(-1)
+    flat_shifty = shifty.view(-1)
+    flat_basex = torch.arange(0, H).view(-1, 1)[None, None].to(img.device).long().repeat(N, C, 1, W).view(-1)
+    flat_basey = torch.arange(0, W).view(1, -1)[None, None].to(img.device).long().repeat(N, C, H, 1).view(-1)
+    flat_weight = weight.view(-1)
+    flat_img = img.contiguous().view(-1)
+    idxn = torch.arange(0, N).view(N, 1, 1, 1).to(img.device).long().repeat(1, C, H, W).view(-1)
+    idxc = torch.arange(0, C).view(1, C, 1, 1).to(img.device).long().repeat(N, 1, H, W).view(-1)
+    idxx = flat_shiftx.long() + flat_basex
+    idxy = flat_shifty.long() + flat_basey
+    mask = idxx.ge(0) & idxx.lt(H) & idxy.ge(0) & idxy.lt(W)
+    ids = (idxn * C * H * W + idxc * H * W + idxx * W + idxy)
+    ids_mask = torch.masked_select(ids, mask).clone()
+    img_warp = torch.zeros([N * C * H * W, ], device=img.device)
+    img_warp.put_(ids_mask, torch.masked_select(flat_img * flat_weight, mask), accumulate=True)
+    one_warp = torch.zeros([N * C * H * W, ], device=img.device)
+    one_warp.put_(ids_mask, torch.masked_select(flat_weight, mask), accumulate=True)
+    return img_warp.view(N, C, H, W), one_warp.view(N, C, H, W)
+
+def z_fwarp_reference(img, flo, z):
+    N, C, _, _ = img.size()
+    y = flo[:, 0:1:, :].repeat(1, C, 1, 1)
+    x = flo[:, 1:2, :, :].repeat(1, C, 1, 1)
+    x1 = torch.floor(x)
+    x2 = x1 + 1
+    y1 = torch.floor(y)
+    y2 = y1 + 1
+    z = z + 1e-5
+    imgw, o = 0, 0
+    for xc, yc in ((x1, y1), (x1, y2), (x2, y1), (x2, y2)):
+        w = z * torch.exp(-((x - xc) ** 2 + (y - yc) ** 2))
+        img_c, o_c = sample_one_reference(img, xc, yc, w)
+        imgw, o = imgw + img_c, o + o_c
+    return imgw, o
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+model_args = argparse.Namespace(gpu=0, nf=64, module_scale_factor=4, img_ch=3)
+vfinet = VFInet(model_args).to(device)
+h, w = args.size
+img = torch.randn(args.batch, args.channels, h, w, device=device) * args.flow
+flo = (torch.rand(args.batch, 2, h, w, device=device) * 2 - 1) * args.flow
+z = torch.rand(args.batch, 1, h, w, device=device)
+
+results = {}
+for name, fn in (('reference', z_fwarp_reference), ('vectorized', vfinet.z_fwarp)):
+    results[name] = fn(img, flo, z)  # Warmup, fills the index cache
+    sync()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        fn(img, flo, z)
+    sync()
+    results[name + '_ms'] = (time.perf_counter() - start) / args.iters * 1000
+    print(f"{name:>10}: {results[name + '_ms']:8.2f} ms/call")
+
+(ref_img, ref_o), (new_img, new_o) = results['reference'], results['vectorized']
+rel = lambda a, b: ((a - b).abs().max() / b.abs().max().clamp(min=1e-12)).item()
+print(f"speedup {results['reference_ms'] / results['vectorized_ms']:.2f}x, max relative diff: splatted {rel(new_img, ref_img):.2e}, weights {rel(new_o, ref_o):.2e}")
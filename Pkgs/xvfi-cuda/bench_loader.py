@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import cv2
+import torch
+
+# Samples/s of the XVFI training loader (get_train_data, CPU only) reading PNG clips against the same clips packed
+# by pack_train.py. Without --input a synthetic X-TRAIN-like set is written to a temporary folder first.
+# Epoch 1 includes worker startup; later epochs reuse the persistent workers.
+# main.py does not train (phase 'train' has no train() and main() quits after testing), so this is the loader's only
+# caller in this tree.
+
+dname = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(dname)
+sys.path.append(os.path.join(os.path.dirname(dname), "common"))
+from utils import get_train_data, make_2D_dataset_X_Train
+from pack_train import pack_clips
+
+def write_synthetic(root, clips, frames, size):
+    # Moving gradients plus noise, so PNG decoding costs about what filmed content does
+    h, w = size
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:h, 0:w]
+    for clip in range(clips):
+        clip_dir = os.path.join(root, 'type1', 'clip{:03d}'.format(clip))
+        os.makedirs(clip_dir)
+        for i in range(frames):
+            base = np.stack(((x + i * 3 + clip * 40) % 256, (y + x // 2 + i) % 256, (y * 2 + clip) % 256), axis=2).astype(np.int16)
+            img = np.clip(base + rng.integers(-6, 7, base.shape), 0, 255).astype(np.uint8)
+            cv2.imwrite(os.path.join(clip_dir, '{:04d}.png'.format(i)), img)
+
+def measure(train_data_path, args):
+    loader_args = argparse.Namespace(dataset='X4K1000FPS', train_data_path=train_data_path, batch_size=args.batch_size,
+                                     num_thrds=args.workers, patch_size=args.patch_size, need_patch=True, img_ch=3)
+    loader = get_train_data(loader_args, max_t_step_size=32)
+    rates = []
+    for epoch in range(args.epochs):
+        samples = 0
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for frames, t_value in loader:
+                samples += frames.size(0)
+        rates.append(samples / (time.perf_counter() - start))
+    return rates
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the XVFI training loader on PNG clips and on a packed store')
+    parser.add_argument('--input', default=None, help='Training set (<type>/<clip>/*.png), synthetic clips if omitted')
+    parser.add_argument('--clips', type=int, default=8, help='Synthetic clips')
+    parser.add_argument('--frames', type=int, default=33, help='Frames per synthetic clip, at least 33 for max_t_step_size 32')
+    parser.add_argument('--size', type=int, nargs=2, default=[768, 768], help='H W of synthetic frames (X-TRAIN clips are 768x768)')
+    parser.add_argument('--patch_size', type=int, default=384)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=4, help='Passes over the clips per timed epoch')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    tmp = tempfile.mkdtemp(prefix='xvfi_loader_')
+    try:
+        png_root = args.input
+        if png_root is None:
+            png_root = os.path.join(tmp, 'png')
+            write_synthetic(png_root, args.clips, args.frames, args.size)
+        packed_root = os.path.join(tmp, 'packed')
+        pack_clips(make_2D_dataset_X_Train(png_root), packed_root, log=None)
+
+        results = {}
+        for name, root in (('png', png_root), ('packed', packed_root)):
+            results[name] = measure(root, args)
+            print("{:>7}: ".format(name) + ", ".join("epoch {} {:7.1f} samples/s".format(e + 1, r) for e, r in enumerate(results[name])))
+        steady = lambda rates: np.mean(rates[1:]) if len(rates) > 1 else rates[0]
+        print("Packed store: {:.1f}x samples/s ({} workers, batch {}, {}x{} patches)".format(
+            steady(results['packed']) / steady(results['png']), args.workers, args.batch_size, args.patch_size, args.patch_size))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -4,6 +4,8 @@ import torch.optim as optim
 import numpy as np
 import sys
 import os
+import io
+import contextlib
 
 abspath = os.path.abspath(__file__)
 wrkdir = os.path.dirname(abspath)
@@ -11,11 +13,15 @@ print("Changing working dir to {0}".format(wrkdir))
 os.chdir(os.path.dirname(wrkdir))
 print("Added {0} to temporary PATH".format(wrkdir))
 sys.path.append(wrkdir)
+sys.path.append(os.path.join(os.path.dirname(wrkdir), "common"))
 
 from torch.autograd import Variable
 from utils import *
 from XVFInet import *
 from collections import Counter
+from ffcommon import buffers
+from ffcommon.pipeline import Pipeline
+from ffcommon.writer import FrameWriter
 
 
 def parse_args():
@@ -69,7 +75,9 @@ def parse_args():
     parser.add_argument('--loss_type', default='L1', choices=['L1', 'MSE', 'L1_Charbonnier_loss'], help='Loss type')
 
     parser.add_argument('--S_trn', type=int, default=3, help='The lowest scale depth for training')
-    parser.add_argument('--S_tst', type=int, default=5, help='The lowest scale depth for test')
+    parser.add_argument('--S_tst', type=int, default=5, help='The lowest scale depth for test (test_custom: the deepest allowed)')
+    parser.add_argument('--fixed_S_tst', action='store_true', help='test_custom: always use S_tst instead of choosing the depth per input')
+    parser.add_argument('--max_motion', type=float, default=0, help='test_custom: largest expected motion between source frames in pixels, 0 = estimate from the resolution')
 
     """ Weighting Parameters Lambda for Losses (when [phase=='train']) """
     parser.add_argument('--rec_lambda', type=float, default=1.0, help='Lambda for Reconstruction Loss')
@@ -77,14 +85,19 @@ def parse_args():
     """ Settings for Testing (when [phase=='test' or 'test_custom']) """
     parser.add_argument('--saving_flow_flag', default=False)
     parser.add_argument('--multiple', type=int, default=8, help='Due to the indexing problem of the file names, we recommend to use the power of 2. (e.g. 2, 4, 8, 16 ...). CAUTION : For the provided X-TEST, multiple should be one of [2, 4, 8, 16, 32].')
+    parser.add_argument('--t_batch', type=int, default=0, help='intermediate frames synthesized per batch at level 0, 0 = all (multiple-1) at once')
     parser.add_argument('--metrics_types', type=list, default=["PSNR", "SSIM", "tOF"], choices=["PSNR", "SSIM", "tOF"])
 
     """ Settings for test_custom (when [phase=='test_custom']) """
     parser.add_argument('--custom_path', type=str, default='./custom_path', help='path for custom video containing frames')
     parser.add_argument('--output', type=str, default='./interp', help='output path')
-    parser.add_argument('--input', type=str, default='./frames', help='input path')
+    parser.add_argument('--input', type=str, default='', help='input frames folder, relative to custom_path (default: its first scene folder)')
     parser.add_argument('--img_format', type=str, default="png")
+    parser.add_argument('--wthreads', type=int, default=4, help='max writer threads')
+    parser.add_argument('--mem_budget', type=float, default=0, help='write buffer memory in MB, 0 = half of available RAM')
     parser.add_argument('--mdl_dir', type=str)
+    parser.add_argument('--all_scenes', action='store_true', help='interpolate every scene folder in custom_path, each into output/<scene>')
+    parser.add_argument('--manifest', type=str, default='', help="file of jobs, one '<frames dir><TAB><output dir>' per line, overrides custom_path")
 
     return check_args(parser.parse_args())
 
@@ -127,14 +140,15 @@ def main():
         print('# {} : {}'.format(arg, getattr(args, arg)))
     device = torch.device(
         'cuda:' + str(args.gpu) if torch.cuda.is_available() else 'cpu')  # will be used as "x.to(device)"
-    torch.cuda.set_device(device)  # change allocation of current GPU
-    # caution!!!! if not "torch.cuda.set_device()":
-    # RuntimeError: grid_sampler(): expected input and grid to be on same device, but input is on cuda:1 and grid is on cuda:0
-    print('Available devices: ', torch.cuda.device_count())
-    print('Current cuda device: ', torch.cuda.current_device())
-    print('Current cuda device name: ', torch.cuda.get_device_name(device))
-    if args.gpu is not None:
-        print("Use GPU: {} is used".format(args.gpu))
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)  # change allocation of current GPU
+        # caution!!!! if not "torch.cuda.set_device()":
+        # RuntimeError: grid_sampler(): expected input and grid to be on same device, but input is on cuda:1 and grid is on cuda:0
+        print('Available devices: ', torch.cuda.device_count())
+        print('Current cuda device: ', torch.cuda.current_device())
+        print('Current cuda device name: ', torch.cuda.get_device_name(device))
+        if args.gpu is not None:
+            print("Use GPU: {} is used".format(args.gpu))
 
     SM = save_manager(args)
 
@@ -151,7 +165,7 @@ def main():
         epoch = args.epochs - 1
 
     elif args.phase == "test" or args.phase == "metrics_evaluation" or args.phase == 'test_custom':
-        checkpoint = SM.load_model(os.path.join(wrkdir, args.mdl_dir))
+        checkpoint = SM.load_model(os.path.join(wrkdir, args.mdl_dir), device)
         model_net.load_state_dict(checkpoint['state_dict_Model'])
         epoch = checkpoint['last_epoch']
 
@@ -160,14 +174,18 @@ def main():
         print("\n-------------------------------------- Final Test starts -------------------------------------- ")
         print('Evaluate on test set (final test) with multiple = %d ' % (args.multiple))
 
-        final_test_loader = get_test_data(args, multiple=args.multiple,
-                                          validation=False)  # multiple is only used for X4K1000FPS
-
-        final_pred_save_path = test(final_test_loader, model_net,
-                                                                  criterion, epoch,
-                                                                  args, device,
-                                                                  multiple=args.multiple,
-                                                                  postfix=postfix, validation=False)
+        if args.phase == 'test_custom':
+            # All jobs share the loaded model, its caches and the cudnn autotuner results
+            test_custom_jobs(model_net, criterion, epoch, args, device, postfix)
+        else:
+            final_test_loader = get_test_data(args, multiple=args.multiple,
+                                              validation=False)  # multiple is only used for X4K1000FPS
+
+            final_pred_save_path = test(final_test_loader, model_net,
+                                                                      criterion, epoch,
+                                                                      args, device,
+                                                                      multiple=args.multiple,
+                                                                      postfix=postfix, validation=False)
         #SM.write_info('Final 4k frames PSNR : {:.4}\n'.format(testPSNR))
 
     if args.dataset == 'X4K1000FPS' and args.phase != 'test_custom':
@@ -318,21 +336,110 @@ def main():
     print("information of model:", args.model_dir)
     print("best_PSNR of model:", best_PSNR)
 
-def write_src_frame(src_path, target_path, args):
-    filename, file_ext = os.path.splitext(src_path)
-    if file_ext == f".{args.img_format}":
-        shutil.copy(src_path, target_path)
+def test_custom_jobs(model_net, criterion, epoch, args, device, postfix):
+    jobs = make_custom_jobs(args)
+    timings = []
+    for job_num, (job_name, frames_dir, output_dir) in enumerate(jobs, 1):
+        print("Job {}/{}: {} => {}".format(job_num, len(jobs), frames_dir, output_dir))
+        start_time = time.time()
+        test_loader = get_test_data(args, multiple=args.multiple, validation=False, frames_dir=frames_dir)
+        test(test_loader, model_net, criterion, epoch, args, device, multiple=args.multiple, postfix=postfix,
+             validation=False, output_path=check_folder(output_dir))
+        elapsed = time.time() - start_time
+        n_frames = (len(test_loader.dataset) - 1) * args.multiple + 1
+        timings.append([job_name, n_frames, elapsed])
+        print("Job {}/{} ({}): {} frames in {:.2f}s ({:.2f} fps)".format(job_num, len(jobs), job_name, n_frames,
+                                                                       elapsed, n_frames / max(elapsed, 1e-6)))
+
+    if len(jobs) > 1:
+        print("------------------------------------------- Jobs ----------------------------------------------")
+        for job_name, n_frames, elapsed in timings:
+            print("{:<40} {:>8} frames {:>9.2f}s {:>8.2f} fps".format(job_name, n_frames, elapsed, n_frames / max(elapsed, 1e-6)))
+        total_frames, total_time = sum(t[1] for t in timings), sum(t[2] for t in timings)
+        print("{:<40} {:>8} frames {:>9.2f}s {:>8.2f} fps".format('Total', total_frames, total_time, total_frames / max(total_time, 1e-6)))
+
+
+# test_custom picks the scale depth per input: the X-TEST 4K clips (2160 lines) are run at S_tst=5 and motion grows with
+# resolution, or, with --max_motion, the coarsest level should see at most COARSEST_MOTION feature pixels of motion
+# (one feature pixel at depth S spans 2**S * module_scale_factor pixels). Deeper levels only add padding.
+S_TST_REF = 5
+S_TST_REF_SIZE = 2160
+COARSEST_MOTION = 4
+
+
+def select_S_tst(args, H, W):
+    if args.fixed_S_tst:
+        return args.S_tst
+    if args.max_motion > 0:
+        depth = math.ceil(math.log2(max(args.max_motion / (args.module_scale_factor * COARSEST_MOTION), 1)))
     else:
-        cv2.imwrite(target_path, cv2.imread(src_path)) 
-
-def test(test_loader, model_net, criterion, epoch, args, device, multiple, postfix, validation):
+        depth = math.ceil(S_TST_REF + math.log2(min(H, W) / S_TST_REF_SIZE))
+    return min(max(depth, 1), args.S_tst)
+
+
+def test_divide(args, S_tst):
+    return 2 ** S_tst * args.module_scale_factor * 4
+
+
+def pad_frame(frame, H_padding, W_padding):
+    # Bottom/right padding mirrors the frame, so the flows at the border see image content rather than a black edge
+    if H_padding == 0 and W_padding == 0:
+        return frame
+    mode = 'reflect' if H_padding < frame.size(2) and W_padding < frame.size(3) else 'replicate'
+    return F.pad(frame, (0, W_padding, 0, H_padding), mode)
+
+
+def conv_flops(module, output):
+    """ FLOPs (two per multiply-accumulate) of one Conv2d/Conv3d call, from its kernel and output shape """
+    return 2 * output.numel() * module.in_channels // module.groups * int(np.prod(module.kernel_size))
+
+
+TEST_FLOPS = {}  # (S_tst, K) -> conv FLOPs per pixel of the padded frame
+
+
+def count_test_flops(args, S_tst, H, W, K):
+    """
+    Conv FLOPs of one pair with K t values at depth S_tst, for a frame padded to HxW. Every conv of the test path runs
+    on HxW divided by a power of two, so its FLOPs are proportional to H*W: the convs are counted once per (S_tst, K)
+    by hooks on a random-weight CPU model at the smallest valid size, and scaled by the pixel count.
+    """
+    if (S_tst, K) not in TEST_FLOPS:
+        with contextlib.redirect_stdout(io.StringIO()):
+            net = args.net_object(args).eval()
+        flops = []
+        hook = lambda module, inputs, output: flops.append(conv_flops(module, output))
+        handles = [m.register_forward_hook(hook) for m in net.modules() if isinstance(m, (nn.Conv2d, nn.Conv3d))]
+        size = test_divide(args, S_tst)
+        with torch.no_grad():
+            net.forward_multi(torch.zeros(1, args.img_ch, 2, size, size), torch.linspace(0, 1, K + 2)[1:-1].view(K, 1), levels=S_tst)
+        for handle in handles:
+            handle.remove()
+        TEST_FLOPS[(S_tst, K)] = sum(flops) / (size * size)
+    return TEST_FLOPS[(S_tst, K)] * H * W
+
+
+def log_test_cost(args, H, W, S_tst, K):
+    shapes = []
+    for depth in (S_tst, args.S_tst):
+        divide = test_divide(args, depth)
+        shapes.append((depth, H + (divide - H % divide) % divide, W + (divide - W % divide) % divide))
+    (_, H_pad, W_pad), (_, H_cfg, W_cfg) = shapes
+    print("S_tst {} (at most {}) for {}x{}: padded to {}x{} instead of {}x{}, {:.1f}% fewer pixels to hold and process"
+          .format(S_tst, args.S_tst, W, H, W_pad, H_pad, W_cfg, H_cfg, 100 * (1 - H_pad * W_pad / (H_cfg * W_cfg))))
+    if shapes[0] == shapes[1]:
+        return
+    flops = [count_test_flops(args, depth, H_shape, W_shape, K) for depth, H_shape, W_shape in shapes]
+    print("Conv GFLOPs per pair: {:.1f} instead of {:.1f} ({:.1f}% fewer)".format(
+        flops[0] / 1e9, flops[1] / 1e9, 100 * (1 - flops[0] / max(flops[1], 1))))
+
+
+def test(test_loader, model_net, criterion, epoch, args, device, multiple, postfix, validation, output_path=None):
     #os.chdir(interp_output_path)
 
     #batch_time = AverageClass('Time:', ':6.3f')
     #losses = AverageClass('testLoss:', ':.4e')
     #PSNRs = AverageClass('testPSNR:', ':.4e')
     #SSIMs = AverageClass('testSSIM:', ':.4e')
-    args.divide = 2 ** (args.S_tst) * args.module_scale_factor * 4
 
     # progress = ProgressMeter(len(test_loader), batch_time, accm_time, losses, PSNRs, SSIMs, prefix='Test after Epoch[{}]: '.format(epoch))
     #progress = ProgressMeter(len(test_loader), PSNRs, SSIMs, prefix='Test after Epoch[{}]: '.format(epoch))
@@ -343,82 +450,68 @@ def test(test_loader, model_net, criterion, epoch, args, device, multiple, postf
     model_net.eval()
     
     counter = 1
-    copied_src_frames = list()
-    last_frame = ""
+    dataset = test_loader.dataset
+    t_values = torch.from_numpy(dataset.t.astype(np.float32)).view(-1, 1).to(device)
+    if output_path is None:
+        output_path = os.path.join(args.custom_path, args.output)
 
     print("------------------------------------------- Test ----------------------------------------------")
-    with torch.no_grad():
-        start_time = time.time()
-        for testIndex, (frames, t_value, scene_name, frameRange) in enumerate(test_loader):
-            # Shape of 'frames' : [1,C,T+1,H,W]
-            frameT = frames[:, :, -1, :, :]  # [1,C,H,W]
-            It_Path, I0_Path, I1_Path = frameRange
-            
-            #print(I0_Path)
-            #print(I1_Path)
-            
-            input_filename = str(I0_Path).split("'")[1];
-            input_filename_next = str(I1_Path).split("'")[1];
-            last_frame = input_filename_next
-
-            frameT = Variable(frameT.to(device))  # ground truth for frameT
-            t_value = Variable(t_value.to(device))
-
-            if (testIndex % (multiple - 1)) == 0:
-                input_frames = frames[:, :, :-1, :, :]  # [1,C,T,H,W]
-                input_frames = Variable(input_frames.to(device))
-
-                B, C, T, H, W = input_frames.size()
-                H_padding = (args.divide - H % args.divide) % args.divide
-                W_padding = (args.divide - W % args.divide) % args.divide
-                if H_padding != 0 or W_padding != 0:
-                    input_frames = F.pad(input_frames, (0, W_padding, 0, H_padding), "constant")
-
-
-            pred_frameT = model_net(input_frames, t_value, is_training=False)
-
-            if H_padding != 0 or W_padding != 0:
-                pred_frameT = pred_frameT[:, :, :H, :W]
-
-            
-            epoch_save_path = args.custom_path
-            scene_save_path = os.path.join(epoch_save_path, scene_name[0])
-            pred_frameT = np.squeeze(pred_frameT.detach().cpu().numpy())
-            test = np.squeeze(frameT.detach().cpu().numpy())
-            output_img = np.around(denorm255_np(np.transpose(pred_frameT, [1, 2, 0])))  # [h,w,c] and [-1,1] to [0,255]
-            #print(os.path.join(scene_save_path, It_Path[0]))
-            
-            frame_src_path = os.path.join(args.custom_path, args.output, '{:0>8d}.{}'.format(counter, args.img_format))
-            src_frame_path = os.path.join(args.custom_path, args.input, input_filename)
-            
-            
-            if os.path.isfile(src_frame_path):
-                if src_frame_path in copied_src_frames:
-                    #print(f"Not copying source frame '{src_frame_path}' because it has already been copied before! - {len(copied_src_frames)}")
-                    pass
-                else:
-                    print(f"S => {os.path.basename(src_frame_path)} => {os.path.basename(frame_src_path)}")
-                    write_src_frame(src_frame_path, frame_src_path, args)
-                    copied_src_frames.append(src_frame_path)
+    # Frames are written by a writer pool while the next ones are computed, source frames are copied as-is
+    pipe = Pipeline()
+    write_buffer = pipe.queue(buffers.memory_budget(args.mem_budget) // 2, name='Write buffer')
+    writer = FrameWriter(pipe, write_buffer, output_path, args.img_format, args.wthreads, level=1, passthrough='copy', log=False)
+    with pipe:
+        with torch.no_grad():
+            start_time = time.time()
+            prev_frame = None
+            # Each source frame is decoded and padded once and kept as I0 of the next pair
+            for frame, frame_idx in test_loader:
+                # Shape of 'frame' : [1,C,H,W] uint8
+                frame = normalize_frames(frame.to(device, non_blocking=True), args.img_ch)
+                frame_idx = int(frame_idx)
+                if prev_frame is None:
+                    # The resolution is fixed within a job, so are the depth and the padding
+                    B, C, H, W = frame.size()
+                    S_tst = select_S_tst(args, H, W)
+                    args.divide = test_divide(args, S_tst)
+                    H_padding = (args.divide - H % args.divide) % args.divide
+                    W_padding = (args.divide - W % args.divide) % args.divide
+                    log_test_cost(args, H, W, S_tst, t_values.size(0))
+                    prev_frame = pad_frame(frame, H_padding, W_padding)
+                    continue
+
+                frame = pad_frame(frame, H_padding, W_padding)
+                input_frames = torch.stack([prev_frame, frame], dim=2)  # [1,C,T,H,W]
+                prev_frame = frame
+                I0_Path, I1_Path = dataset.frame_index.path(frame_idx - 1), dataset.frame_index.path(frame_idx)
+
+                # Pyramid and flows are shared by all t of the pair, so every t is synthesized in one call.
+                # I0 is the previous pair's I1, whose features are cached by the model
+                pred_frames = model_net.forward_multi(input_frames, t_values, args.t_batch, keys=(I0_Path, I1_Path), levels=S_tst)
+                pred_frames = pred_frames[:, :, :H, :W]
+
+                print(f"S => {os.path.basename(I0_Path)} => {'{:0>8d}.{}'.format(counter, args.img_format)}")
+                write_buffer.put([counter, I0_Path])
+                counter += 1
+
+                # [K,C,H,W] in [-1,1] -> K uint8 [h,w,c] images, one device-to-host copy for the whole pair
+                output_imgs = np.around(denorm255_np(pred_frames.permute(0, 2, 3, 1).cpu().numpy())).astype(np.uint8)
+                for output_img in output_imgs:
+                    print(f"I => {'{:0>8d}.{}'.format(counter, args.img_format)}")
+                    write_buffer.put([counter, output_img])
                     counter += 1
-            
-            frame_interp_path = os.path.join(args.custom_path, args.output, '{:0>8d}.{}'.format(counter, args.img_format))
-            print(f"I => {os.path.basename(frame_interp_path)}")
-            cv2.imwrite(frame_interp_path, output_img.astype(np.uint8))
-            counter += 1
-
-            #losses.update(0.0, 1)
-            #PSNRs.update(0.0, 1)
-            #SSIMs.update(0.0, 1)
 
-        print("-----------------------------------------------------------------------------------------------")
+            print("-----------------------------------------------------------------------------------------------")
 
-    frame_src_path = os.path.join(args.custom_path, args.output, '{:0>8d}.{}'.format(counter, args.img_format))
-    print(f"LAST S => {frame_src_path}")
-    src_frame_path = os.path.join(args.custom_path, args.input, last_frame)
-    write_src_frame(src_frame_path, frame_src_path, args)
+        last_frame = dataset.frame_index.path(len(dataset) - 1)
+        print(f"LAST S => {os.path.join(output_path, '{:0>8d}.{}'.format(counter, args.img_format))}")
+        write_buffer.put([counter, last_frame])
+        pipe.close(write_buffer)
 
-    return epoch_save_path
+    print(write_buffer.stats())
+    for line in writer.stats():
+        print(line)
+    return args.custom_path
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+# Packs an X-TRAIN style tree (<type>/<clip>/*.png) into the memory-mapped store X_Train reads patches from:
+# frames.u8 with every clip's decoded (T,H,W,3) uint8 frames back to back, and clips.npy indexing them.
+# The store holds raw pixels (65 x 768x768x3 = 115 MB per X-TRAIN clip), trading disk space for decode time.
+# The index is written last, so an interrupted pack is not picked up as a store.
+
+dname = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(dname)
+sys.path.append(os.path.join(os.path.dirname(dname), "common"))
+from utils import make_2D_dataset_X_Train, PACK_INDEX, PACK_DATA
+
+def pack_clips(clips, output, threads=8, log=print):
+    os.makedirs(output, exist_ok=True)
+    index = np.zeros((len(clips), 5), np.int64)
+    offset = 0
+    with open(os.path.join(output, PACK_DATA), 'wb') as f, ThreadPoolExecutor(threads) as pool:
+        for clip_idx, frame_paths in enumerate(clips):
+            if not frame_paths:
+                raise RuntimeError("Clip {} has no frames".format(clip_idx))
+            # cv2 releases the GIL while decoding, so the frames of a clip decode in parallel and are written in order
+            for frame_idx, frame in enumerate(pool.map(cv2.imread, frame_paths)):
+                if frame is None:
+                    raise RuntimeError("Could not read " + frame_paths[frame_idx])
+                if frame_idx == 0:
+                    shape = frame.shape
+                elif frame.shape != shape:
+                    raise RuntimeError("{} is {} but the clip's frames are {}".format(frame_paths[frame_idx], frame.shape, shape))
+                f.write(np.ascontiguousarray(frame).data)
+            index[clip_idx] = (offset, len(frame_paths)) + shape
+            offset += len(frame_paths) * shape[0] * shape[1] * shape[2]
+            if log is not None:
+                log("{}/{}: {} frames of {}x{} from {}".format(clip_idx + 1, len(clips), len(frame_paths), shape[1], shape[0],
+                                                              os.path.dirname(frame_paths[0])))
+    np.save(os.path.join(output, PACK_INDEX), index)
+    return offset
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack XVFI training clips into a memory-mapped uint8 store')
+    parser.add_argument('--input', required=True, help='Training set, <type>/<clip>/*.png (e.g. X-TRAIN)')
+    parser.add_argument('--output', required=True, help='Store folder, pass it as --train_data_path')
+    parser.add_argument('--threads', type=int, default=8, help='Decoder threads')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    size = pack_clips(make_2D_dataset_X_Train(args.input), args.output, args.threads)
+    print("Packed {:.1f} GB in {:.1f}s into {}".format(size / 1e9, time.time() - start_time, args.output))
@@ -1,5 +1,5 @@
 from __future__ import division
-import os, glob, sys, torch, shutil, random, math, time, cv2
+import os, glob, sys, torch, shutil, random, math, time, cv2, csv
 import numpy as np
 import torch.utils.data as data
 import torch.nn as nn
@@ -11,6 +11,9 @@ from torch.nn import init
 #from skimage.metrics import structural_similarity
 from torch.autograd import Variable
 from torchvision import models
+from ffcommon.frameindex import FrameIndex
+from ffcommon import device as ffdevice
+from ffcommon import metrics as ffmetrics
 
 
 class save_manager():
@@ -68,9 +71,9 @@ class save_manager():
             checkpoint['best_PSNR']))
         return checkpoint
 
-    def load_model(self, mdl_dir):
+    def load_model(self, mdl_dir, device):
         # checkpoint = torch.load(self.checkpoint_dir + '/' + self.model_dir + '_latest.pt')
-        checkpoint = torch.load(os.path.join(mdl_dir, "checkpoint.pt"), map_location='cuda:0')
+        checkpoint = ffdevice.load(os.path.join(mdl_dir, "checkpoint.pt"), device)
         print("load model '{}', epoch: {},".format(
             os.path.join(mdl_dir, "checkpoint.pt"), checkpoint['last_epoch'] + 1))
         return checkpoint
@@ -103,34 +106,51 @@ def get_train_data(args, max_t_step_size):
         data_train = X_Train(args, max_t_step_size)
     elif args.dataset == 'Vimeo':
         data_train = Vimeo_Train(args)
+    # Meant to be built once per run: persistent workers keep their memory maps and decoders across epochs, the
+    # sampler still reshuffles every epoch. Batches land in pinned memory for async uploads
+    num_workers = int(args.num_thrds)
+    worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4} if num_workers > 0 else {}  # torch 1.8 rejects them without workers
     dataloader = torch.utils.data.DataLoader(data_train, batch_size=args.batch_size, drop_last=True, shuffle=True,
-                                             num_workers=int(args.num_thrds), pin_memory=False)
+                                             num_workers=num_workers, pin_memory=torch.cuda.is_available(), **worker_kwargs)
     return dataloader
 
 
-def get_test_data(args, multiple, validation):
+def get_test_data(args, multiple, validation, frames_dir=None):
     if args.dataset == 'X4K1000FPS' and args.phase != 'test_custom':
         data_test = X_Test(args, multiple, validation)  # 'validation' for validation while training for simplicity
     elif args.dataset == 'Vimeo' and args.phase != 'test_custom':
         data_test = Vimeo_Test(args, validation)
     elif args.phase == 'test_custom':
-        data_test = Custom_Test(args, multiple)
+        data_test = Custom_Test(args, multiple, frames_dir)
+        # Frames are decoded by worker processes ahead of inference, into pinned memory for async uploads.
+        # prefetch_factor is only passed with workers, torch 1.8 rejects any non-default value without them
+        worker_kwargs = {'prefetch_factor': 2} if args.num_thrds > 0 else {}
+        return torch.utils.data.DataLoader(data_test, batch_size=1, shuffle=False, num_workers=args.num_thrds,
+                                           pin_memory=torch.cuda.is_available(), **worker_kwargs)
     dataloader = torch.utils.data.DataLoader(data_test, batch_size=1, drop_last=True, shuffle=False, pin_memory=False)
     return dataloader
 
 
 def frames_loader_train(args, candidate_frames, frameRange):
-    frames = []
-    for frameIndex in frameRange:
-        frame = cv2.imread(candidate_frames[frameIndex])
-        frames.append(frame)
-    (ih, iw, c) = frame.shape
-    frames = np.stack(frames, axis=0)  # (T, H, W, 3)
+    if isinstance(candidate_frames, np.ndarray):
+        # Packed clip (T, H, W, 3): crop on read, only the patch rows of the three frames are paged in from the map
+        (_, ih, iw, c) = candidate_frames.shape
+        frames = candidate_frames
+    else:
+        frames = []
+        for frameIndex in frameRange:
+            frame = cv2.imread(candidate_frames[frameIndex])
+            frames.append(frame)
+        (ih, iw, c) = frame.shape
+        frames = np.stack(frames, axis=0)  # (T, H, W, 3)
+        frameRange = slice(None)
     if args.need_patch:  ## random crop
         ps = args.patch_size
         ix = random.randrange(0, iw - ps + 1)
         iy = random.randrange(0, ih - ps + 1)
-        frames = frames[:, iy:iy + ps, ix:ix + ps, :]
+        frames = frames[frameRange, iy:iy + ps, ix:ix + ps, :]
+    else:
+        frames = frames[frameRange]
 
     if random.random() < 0.5:  # random horizontal flip
         frames = frames[:, :, ::-1, :]
@@ -167,6 +187,15 @@ def frames_loader_test(args, I0I1It_Path, validation):
     return frames
 
 
+def normalize_frames(frames, channel):
+    """ uint8 tensor [..., C, H, W] -> float32 [-1,1], the same values as RGBframes_np2Tensor """
+    frames = frames.float()
+    if channel == 1:
+        weights = frames.new_tensor([65.481, 128.553, 24.966]).view(3, 1, 1)
+        frames = (frames * weights / 255.0).sum(dim=-3, keepdim=True) + 16.0
+    return (frames / 255.0 - 0.5) * 2
+
+
 def RGBframes_np2Tensor(imgIn, channel):
     ## input : T, H, W, C
     if channel == 1:
@@ -176,7 +205,7 @@ def RGBframes_np2Tensor(imgIn, channel):
 
     # to Tensor
     ts = (3, 0, 1, 2)  ############# dimension order should be [C, T, H, W]
-    imgIn = torch.Tensor(imgIn.transpose(ts).astype(float)).mul_(1.0)
+    imgIn = torch.from_numpy(np.ascontiguousarray(imgIn.transpose(ts))).float()  # uint8 frames convert exactly, no float64 copy
 
     # normalization [-1,1]
     imgIn = (imgIn / 255.0 - 0.5) * 2
@@ -256,55 +285,159 @@ def RGBframes_np2Tensor(imgIn, channel):
     def __len__(self):
         return self.num_scene
 
-def make_2D_dataset_Custom_Test(dir, multiple):
-    """ make [I0,I1,It,t,scene_folder] """
-    """ 1D (accumulated) """
-    testPath = []
-    t = np.linspace((1 / multiple), (1 - (1 / multiple)), (multiple - 1))
-    for scene_folder in sorted(glob.glob(os.path.join(dir, '*', ''))):  # [scene1, scene2, scene3, ...]
-        frame_folder = sorted(glob.glob(scene_folder + '*.*'))  # ex) ['00000.png',...,'00123.png']
-        for idx in range(0, len(frame_folder)):
-            if idx == len(frame_folder) - 1:
-                break
-            for suffix, mul in enumerate(range(multiple - 1)):
-                I0I1It_paths = []
-                I0I1It_paths.append(frame_folder[idx])  # I0 (fix)
-                I0I1It_paths.append(frame_folder[idx + 1])  # I1 (fix)
-                target_t_Idx = frame_folder[idx].split(os.sep)[-1].split('.')[0]+'_' + str(suffix).zfill(3) + '.png'
-                # ex) target t name: 00017.png => '00017_1.png'
-                I0I1It_paths.append(os.path.join(scene_folder, target_t_Idx))  # It
-                I0I1It_paths.append(t[mul]) # t
-                I0I1It_paths.append(frame_folder[idx].split(os.path.join(dir, ''))[-1].split(os.sep)[0])  # scene1
-                testPath.append(I0I1It_paths)
-        break # limit to 1 directory - nmkd
-    return testPath
+def make_2D_dataset_X_Train(dir):
+    """ [frame paths of one clip] per clip folder in dir/<scene type>/<clip>, 65 frames each for X-TRAIN """
+    framesPath = []
+    for scene_path in sorted(glob.glob(os.path.join(dir, '*', ''))):
+        for sample_path in sorted(glob.glob(os.path.join(scene_path, '*', ''))):
+            framesPath.append(sorted(glob.glob(os.path.join(sample_path, '*.png'))))
+    print("The number of total training samples : {}".format(len(framesPath)))
+    return framesPath
 
 
+PACK_INDEX = 'clips.npy'
+PACK_DATA = 'frames.u8'
 
-class Custom_Test(data.Dataset):
-    def __init__(self, args, multiple):
-        self.args = args
-        self.multiple = multiple
-        self.testPath = make_2D_dataset_Custom_Test(self.args.custom_path, self.multiple)
-        self.nIterations = len(self.testPath)
 
-        # Raise error if no images found in test_data_path.
-        if len(self.testPath) == 0:
-            raise (RuntimeError("Found 0 files in subfolders of: " + self.args.custom_path + "\n"))
+class PackedClips:
+    """
+    Training clips packed by pack_train.py: PACK_DATA holds every clip as raw uint8 (T,H,W,3) BGR frames back to back,
+    PACK_INDEX one [byte offset, T, H, W, C] row per clip. Items are (T,H,W,3) views of a read-only memory map, so
+    slicing a patch reads only the pages it touches. Each DataLoader worker maps the file itself on first access.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = np.load(os.path.join(directory, PACK_INDEX))
+        self.data = None
+
+    @staticmethod
+    def exists(directory):
+        return os.path.isfile(os.path.join(directory, PACK_INDEX))
+
+    def __getstate__(self):
+        return dict(self.__dict__, data=None)  # Pickling a memmap would copy the whole file into every worker
 
     def __getitem__(self, idx):
-        I0, I1, It, t_value, scene_name = self.testPath[idx]
-        dummy_dir = I1 # due to there is not ground truth intermediate frame.
-        I0I1It_Path = [I0, I1, dummy_dir]
+        if self.data is None:
+            self.data = np.memmap(os.path.join(self.directory, PACK_DATA), np.uint8, 'r')
+        offset, T, H, W, C = (int(v) for v in self.index[idx])
+        return self.data[offset:offset + T * H * W * C].reshape(T, H, W, C)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class X_Train(data.Dataset):
+    """
+    Random (I0, I1, It) triplets with temporal distance 2..max_t_step_size from each clip, cropped, flipped and rotated.
+    train_data_path is either the X-TRAIN folder tree (PNG decoded whole, then cropped) or a pack_train.py store
+    (patches cropped straight from the memory map).
+    """
+    def __init__(self, args, max_t_step_size):
+        self.args = args
+        self.max_t_step_size = max_t_step_size
+        if PackedClips.exists(self.args.train_data_path):
+            self.framesPath = PackedClips(self.args.train_data_path)
+        else:
+            self.framesPath = make_2D_dataset_X_Train(self.args.train_data_path)
+        self.nScenes = len(self.framesPath)
 
-        frames = frames_loader_test(self.args, I0I1It_Path, None)
+        # Raise error if no images found in train_data_path.
+        if self.nScenes == 0:
+            raise (RuntimeError("Found 0 files in subfolders of: " + self.args.train_data_path + "\n"))
+
+    def __getitem__(self, idx):
+        candidate_frames = self.framesPath[idx]  # frame paths, or a packed (T,H,W,3) clip
+        t_step_size = random.randint(2, min(self.max_t_step_size, len(candidate_frames) - 1))
+        t_list = np.linspace((1 / t_step_size), (1 - (1 / t_step_size)), (t_step_size - 1))
+
+        firstFrameIdx = random.randint(0, len(candidate_frames) - 1 - t_step_size)
+        interIdx = random.randint(1, t_step_size - 1)  # relative index, 1~t_step_size-1
+        interFrameIdx = firstFrameIdx + interIdx  # absolute index
+        t_value = t_list[interIdx - 1]  # [0,1]
+
+        if random.randint(0, 1):
+            frameRange = [firstFrameIdx, firstFrameIdx + t_step_size, interFrameIdx]
+        else:  ## temporally reversed order
+            frameRange = [firstFrameIdx + t_step_size, firstFrameIdx, interFrameIdx]
+            t_value = 1.0 - t_value
+
+        frames = frames_loader_train(self.args, candidate_frames, frameRange)
         # including "np2Tensor [-1,1] normalized"
 
-        I0_path = I0.split(os.sep)[-1]
-        I1_path = I1.split(os.sep)[-1]
-        It_path = It.split(os.sep)[-1]
+        return frames, np.expand_dims(np.array(t_value, dtype=np.float32), 0)
 
-        return frames, np.expand_dims(np.array(t_value, dtype=np.float32), 0), scene_name, [It_path, I0_path, I1_path]
+    def __len__(self):
+        return self.nScenes
+
+
+def make_2D_dataset_Custom_Test(dir, exclude=()):
+    """ [scene_folder] of every scene in dir, skipping the folders in exclude (output folders inside dir) """
+    exclude = {os.path.realpath(path) for path in exclude}
+    return sorted(entry.name for entry in os.scandir(dir) if entry.is_dir() and not entry.name.startswith('.')
+                  and os.path.realpath(entry.path) not in exclude)
+
+
+def make_custom_jobs(args):
+    """
+    [job_name, frames_dir, output_dir] for test_custom. By default args.input (relative to args.custom_path) is
+    interpolated into args.output, or without args.input the first scene folder of args.custom_path; with
+    args.all_scenes every scene folder is, each into its own args.output/<scene>;
+    args.manifest lists one job per line as '<frames_dir><TAB><output_dir>' ('#' starts a comment).
+    """
+    if args.manifest:
+        jobs = []
+        with open(args.manifest, encoding='utf-8') as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                frames_dir, _, output_dir = (part.strip() for part in line.partition('\t'))
+                if not frames_dir or not output_dir:
+                    raise RuntimeError("{}:{}: expected '<frames_dir><TAB><output_dir>'".format(args.manifest, line_num))
+                jobs.append([os.path.basename(os.path.normpath(frames_dir)), frames_dir, output_dir])
+        if not jobs:
+            raise RuntimeError("No jobs in manifest: " + args.manifest)
+        return jobs
+
+    output_path = os.path.join(args.custom_path, args.output)
+    if args.input and not args.all_scenes:
+        frames_dir = os.path.join(args.custom_path, args.input)
+        return [[os.path.basename(os.path.normpath(frames_dir)), frames_dir, output_path]]
+    scenes = make_2D_dataset_Custom_Test(args.custom_path, exclude=[output_path])
+    if not scenes:
+        raise RuntimeError("Found no scene folders in: " + args.custom_path)
+    if args.all_scenes:
+        return [[scene, os.path.join(args.custom_path, scene), os.path.join(output_path, scene)] for scene in scenes]
+    return [[scenes[0], os.path.join(args.custom_path, scenes[0]), output_path]]
+
+
+class Custom_Test(data.Dataset):
+    """
+    One item per source frame, in order: [uint8 frame (C,H,W) in BGR as read, frame index]. Each frame is decoded
+    exactly once; test() keeps the previous frame to form pairs and derives all t of a pair from self.t.
+    There is no ground truth in custom mode, so nothing else is loaded. Normalize on the device with
+    normalize_frames(), which matches RGBframes_np2Tensor.
+    """
+    def __init__(self, args, multiple, frames_dir=None):
+        self.args = args
+        self.multiple = multiple
+        self.t = np.linspace((1 / multiple), (1 - (1 / multiple)), (multiple - 1))
+        if frames_dir is None:
+            _, frames_dir, _ = make_custom_jobs(args)[0]
+        self.scene_name = os.path.basename(os.path.normpath(frames_dir))
+        self.frame_index = FrameIndex(frames_dir)
+        self.nIterations = len(self.frame_index)
+
+        # Raise error if no frame pairs found in test_data_path.
+        if self.nIterations < 2:
+            raise (RuntimeError("Found no frame pairs in: " + frames_dir + "\n"))
+
+    def __getitem__(self, idx):
+        frame = cv2.imread(self.frame_index.path(idx))
+        if frame is None:
+            raise RuntimeError("Could not read " + self.frame_index.path(idx))
+        return torch.from_numpy(np.ascontiguousarray(frame.transpose(2, 0, 1))), idx
 
     def __len__(self):
         return self.nIterations
@@ -382,7 +515,7 @@ class ProgressMeter(object):
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
 
-def metrics_evaluation_X_Test(pred_save_path, test_data_path, metrics_types, flow_flag=False, multiple=8, server=None):
+def metrics_evaluation_X_Test(pred_save_path, test_data_path, metrics_types, flow_flag=False, multiple=8, workers=0):
     """
         pred_save_path = './test_img_dir/XVFInet_exp1/epoch_00099' when 'args.epochs=100'
         test_data_path = ex) 'F:/Jihyong/4K_1000fps_dataset/VIC_4K_1000FPS/X_TEST'
@@ -395,199 +528,53 @@ def metrics_evaluation_X_Test(pred_save_path, test_data_path, metrics_types, flo
                     -type3
                         :
                         -scene5
-        "metrics_types": ["PSNR", "SSIM", "LPIPS", "tOF", "tLP100"]
+        "metrics_types": ["PSNR", "SSIM", "tOF"]
         "flow_flag": option for saving motion visualization
-        "final_test_type": ['first_interval', 1, 2, 3, 4]
         "multiple": x4, x8, x16, x32 for interpolation
+        "workers": metric processes, 0 = one per physical core
+        Frames are evaluated in parallel by ffcommon.metrics, per-frame results stream to total_metrics.csv.
      """
 
-    pred_framesPath = []
+    # Only predicted frames are compared (frame 0 and frame 'multiple' are the inputs), the tOF of the first one is
+    # measured from input frame 0 for both the prediction and the GT
+    sequences = []
     for type_folder in sorted(glob.glob(os.path.join(pred_save_path, '*', ''))):  # [type1,type2,type3,...]
         for scene_folder in sorted(glob.glob(os.path.join(type_folder, '*', ''))):  # [scene1,scene2,..]
-            scene_framesPath = []
-            for frame_path in sorted(glob.glob(scene_folder + '*.png')):
-                scene_framesPath.append(frame_path)
-            pred_framesPath.append(scene_framesPath)
-    if len(pred_framesPath) == 0:
+            scene_framesPath = sorted(glob.glob(scene_folder + '*.png'))
+            if not scene_framesPath or os.path.normpath(scene_folder).endswith('_tOF_flow'):  # flow_flag visualizations
+                continue
+            scene = os.path.relpath(scene_folder, pred_save_path).replace(os.sep, '/')  # ex) 'Fast/003_TEST_Fast'
+            items = [(os.path.basename(pred_frame), pred_frame, pred_frame.replace(pred_save_path, test_data_path))
+                     for pred_frame in scene_framesPath[1:multiple]]
+            sequences.append((scene, items, (scene_framesPath[0], scene_framesPath[0])))
+    if len(sequences) == 0:
         raise (RuntimeError("Found 0 files in " + pred_save_path + "\n"))
 
-    # GT_framesPath = make_2D_dataset_X_Test(test_data_path, multiple, t_step_size=32)
-    # pred_framesPath = make_2D_dataset_X_Test(pred_save_path, multiple, t_step_size=32)
-
-    # ex) pred_save_path: './test_img_dir/XVFInet_exp1/epoch_00099' when 'args.epochs=100'
-    # ex) framesPath: [['./VIC_4K_1000FPS/VIC_Test/Fast/003_TEST_Fast/00000.png',...], ..., []] 2D List, len=30
-    # ex) scenesFolder: ['Fast/003_TEST_Fast',...]
-
-    keys = metrics_types
-    len_dict = dict.fromkeys(keys, 0)
-    Total_avg_dict = dict.fromkeys(["TotalAvg_" + _ for _ in keys], 0)
-    Type1_dict = dict.fromkeys(["Type1Avg_" + _ for _ in keys], 0)
-    Type2_dict = dict.fromkeys(["Type2Avg_" + _ for _ in keys], 0)
-    Type3_dict = dict.fromkeys(["Type3Avg_" + _ for _ in keys], 0)
-
-    # LPIPSnet = dm.DistModel()
-    # LPIPSnet.initialize(model='net-lin', net='alex', use_gpu=True)
-
-    total_list_dict = {}
-    key_str = 'Metrics -->'
-    for key_i in keys:
-        total_list_dict[key_i] = []
-        key_str += ' ' + str(key_i)
-    key_str += ' will be measured.'
-    print(key_str)
-
-    for scene_idx, scene_folder in enumerate(pred_framesPath):
-        per_scene_list_dict = {}
-        for key_i in keys:
-            per_scene_list_dict[key_i] = []
-        pred_candidate = pred_framesPath[scene_idx]  # get all frames in pred_framesPath
-        # GT_candidate = GT_framesPath[scene_idx]  # get 4800 frames
-        # num_pred_frame_per_folder = len(pred_candidate)
-
-        # save_path = os.path.join(pred_save_path, pred_scenesFolder[scene_idx])
-        save_path = scene_folder[0]
-        # './test_img_dir/XVFInet_exp1/epoch_00099/type1/scene1'
-
-        # excluding both frame0 and frame1 (multiple of 32 indices)
-        for frameIndex, pred_frame in enumerate(pred_candidate):
-            # if server==87:
-            # GTinterFrameIdx = pred_frame.split('/')[-1]  # ex) 8, when multiple = 4, # 87 server
-            # else:
-            # GTinterFrameIdx = pred_frame.split('\\')[-1]  # ex) 8, when multiple = 4
-            # if not (GTinterFrameIdx % 32) == 0:
-            if frameIndex > 0 and frameIndex < multiple:
-                """ only compute predicted frames (excluding multiples of 32 indices), ex) 8, 16, 24, 40, 48, 56, ... """
-                output_img = cv2.imread(pred_frame).astype(np.float32)  # BGR, [0,255]
-                target_img = cv2.imread(pred_frame.replace(pred_save_path, test_data_path)).astype(
-                    np.float32)  # BGR, [0,255]
-                pred_frame_split = pred_frame.split(os.sep)
-                msg = "[x%d] frame %s, " % (
-                multiple, os.path.join(pred_frame_split[-3], pred_frame_split[-2], pred_frame_split[-1]))  # per frame
-
-                if "tOF" in keys:  # tOF
-                    # if (GTinterFrameIdx % 32) == int(32/multiple):
-                    # if (frameIndex % multiple) == 1:
-                    if frameIndex == 1:
-                        # when first predicted frame in each interval
-                        pre_out_grey = cv2.cvtColor(cv2.imread(pred_candidate[0]).astype(np.float32),
-                                                    cv2.COLOR_BGR2GRAY)  #### CAUTION BRG
-                        # pre_tar_grey = cv2.cvtColor(cv2.imread(pred_candidate[0].replace(pred_save_path, test_data_path)), cv2.COLOR_BGR2GRAY)  #### CAUTION BRG
-                        pre_tar_grey = pre_out_grey  #### CAUTION BRG
-
-                    # if not H_match_flag or not W_match_flag:
-                    #    pre_tar_grey = pre_tar_grey[:new_t_H, :new_t_W, :]
-
-                    # pre_tar_grey = pre_out_grey
-
-                    output_grey = cv2.cvtColor(output_img, cv2.COLOR_BGR2GRAY)
-                    target_grey = cv2.cvtColor(target_img, cv2.COLOR_BGR2GRAY)
-
-                    target_OF = cv2.calcOpticalFlowFarneback(pre_tar_grey, target_grey, None, 0.5, 3, 15, 3, 5, 1.2, 0)
-                    output_OF = cv2.calcOpticalFlowFarneback(pre_out_grey, output_grey, None, 0.5, 3, 15, 3, 5, 1.2, 0)
-                    # target_OF, ofy, ofx = crop_8x8(target_OF) #check for size reason
-                    # output_OF, ofy, ofx = crop_8x8(output_OF)
-                    OF_diff = np.absolute(target_OF - output_OF)
-                    if flow_flag:
-                        """ motion visualization """
-                        flow_path = save_path + '_tOF_flow'
-                        check_folder(flow_path)
-                        # './test_img_dir/XVFInet_exp1/epoch_00099/Fast/003_TEST_Fast_tOF_flow'
-                        tOFpath = os.path.join(flow_path, "tOF_flow_%05d.png" % (GTinterFrameIdx))
-                        # ex) "./test_img_dir/epoch_005/Fast/003_TEST_Fast/00008_tOF" when start_idx=0, multiple=4, frameIndex=0
-                        hsv = np.zeros_like(output_img)  # check for size reason
-                        hsv[..., 1] = 255
-                        mag, ang = cv2.cartToPolar(OF_diff[..., 0], OF_diff[..., 1])
-                        # print("tar max %02.6f, min %02.6f, avg %02.6f" % (mag.max(), mag.min(), mag.mean()))
-                        maxV = 0.4
-                        mag = np.clip(mag, 0.0, maxV) / maxV
-                        hsv[..., 0] = ang * 180 / np.pi / 2
-                        hsv[..., 2] = mag * 255.0  #
-                        bgr = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-                        cv2.imwrite(tOFpath, bgr)
-                        print("png for motion visualization has been saved in [%s]" %
-                              (flow_path))
-                    OF_diff_tmp = np.sqrt(np.sum(OF_diff * OF_diff, axis=-1)).mean()  # l1 vector norm
-                    # OF_diff, ofy, ofx = crop_8x8(OF_diff)
-                    total_list_dict["tOF"].append(OF_diff_tmp)
-                    per_scene_list_dict["tOF"].append(OF_diff_tmp)
-                    msg += "tOF %02.2f, " % (total_list_dict["tOF"][-1])
-
-                    pre_out_grey = output_grey
-                    pre_tar_grey = target_grey
-
-                # target_img, ofy, ofx = crop_8x8(target_img)
-                # output_img, ofy, ofx = crop_8x8(output_img)
-
-                if "PSNR" in keys:  # psnr
-                    psnr_tmp = psnr(target_img, output_img)
-                    total_list_dict["PSNR"].append(psnr_tmp)
-                    per_scene_list_dict["PSNR"].append(psnr_tmp)
-                    msg += "PSNR %02.2f" % (total_list_dict["PSNR"][-1])
-
-                if "SSIM" in keys:  # ssim
-                    ssim_tmp = ssim_bgr(target_img, output_img)
-                    total_list_dict["SSIM"].append(ssim_tmp)
-                    per_scene_list_dict["SSIM"].append(ssim_tmp)
-
-                    msg += ", SSIM %02.2f" % (total_list_dict["SSIM"][-1])
-
-                # msg += ", crop (%d, %d)" % (ofy, ofx) # per frame (not scene)
-                print(msg)
-
-        """ after finishing one scene """
-        per_scene_pd_dict = {}  # per scene
-        for cur_key in keys:
-            # save_path = './test_img_dir/XVFInet_exp1/epoch_00099/Fast/003_TEST_Fast'
-            num_data = cur_key + "_[x%d]_[%s]" % (multiple, save_path.split(os.sep)[-2])  # '003_TEST_Fast'
-            # num_data => ex) PSNR_[x8]_[041_TEST_Fast]
-            """ per scene """
-            per_scene_cur_list = np.float32(per_scene_list_dict[cur_key])
-            per_scene_pd_dict[num_data] = pd.Series(per_scene_cur_list)  # dictionary
-            per_scene_num_data_sum = per_scene_cur_list.sum()
-            per_scene_num_data_len = per_scene_cur_list.shape[0]
-            per_scene_num_data_mean = per_scene_num_data_sum / per_scene_num_data_len
-            """ accumulation """
-            cur_list = np.float32(total_list_dict[cur_key])
-            num_data_sum = cur_list.sum()
-            num_data_len = cur_list.shape[0]  # accum
-            num_data_mean = num_data_sum / num_data_len
-            print(" %s, (per scene) max %02.4f, min %02.4f, avg %02.4f" %
-                  (num_data, per_scene_cur_list.max(), per_scene_cur_list.min(), per_scene_num_data_mean))  #
-
-            Total_avg_dict["TotalAvg_" + cur_key] = num_data_mean  # accum, update every iteration.
-
-            len_dict[cur_key] = num_data_len  # accum, update every iteration.
-
-            # folder_dict["FolderAvg_" + cur_key] += num_data_mean
-            if scene_idx < 5:
-                Type1_dict["Type1Avg_" + cur_key] += per_scene_num_data_mean
-            elif (scene_idx >= 5) and (scene_idx < 10):
-                Type2_dict["Type2Avg_" + cur_key] += per_scene_num_data_mean
-            elif (scene_idx >= 10) and (scene_idx < 15):
-                Type3_dict["Type3Avg_" + cur_key] += per_scene_num_data_mean
-
-        mode = 'w' if scene_idx == 0 else 'a'
-
-        total_csv_path = os.path.join(pred_save_path, "total_metrics.csv")
-        # ex) pred_save_path: './test_img_dir/XVFInet_exp1/epoch_00099' when 'args.epochs=100'
-        pd.DataFrame(per_scene_pd_dict).to_csv(total_csv_path, mode=mode)
-
-    """ combining all results after looping all scenes. """
+    keys = [key for key in metrics_types if key in ffmetrics.METRICS]
+    print('Metrics --> ' + ' '.join(keys) + ' will be measured.')
+    total_csv_path = os.path.join(pred_save_path, "total_metrics.csv")
+    results = ffmetrics.evaluate(sequences, total_csv_path, keys, workers, flow_root=pred_save_path if flow_flag else None,
+                                 log=lambda msg: print("[x%d] %s" % (multiple, msg)))
+
+    """ after all scenes """
+    summary = {}
+    for scene_idx, (scene, scene_results) in enumerate(results.items()):
+        for key in keys:
+            scene_values = np.float32(scene_results[key])
+            print(" %s_[x%d]_[%s], (per scene) max %02.4f, min %02.4f, avg %02.4f" %
+                  (key, multiple, scene.split('/')[-1], scene_values.max(), scene_values.min(), ffmetrics.mean(scene_results[key])))
+            summary.setdefault(("TotalAvg", key), []).extend(scene_results[key])
+            if scene_idx < 15:  # Types of five scenes each
+                summary.setdefault(("Type%dAvg" % (scene_idx // 5 + 1), key), []).append(ffmetrics.mean(scene_results[key]))
+
+    with open(total_csv_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        for avg_name in ["TotalAvg", "Type1Avg", "Type2Avg", "Type3Avg"]:
+            writer.writerow([avg_name, ''] + ['{:.6f}'.format(ffmetrics.mean(summary.get((avg_name, key), []))) for key in keys])
     for key in keys:
-        Total_avg_dict["TotalAvg_" + key] = pd.Series(
-            np.float32(Total_avg_dict["TotalAvg_" + key]))  # replace key (update)
-        Type1_dict["Type1Avg_" + key] = pd.Series(np.float32(Type1_dict["Type1Avg_" + key] / 5))  # replace key (update)
-        Type2_dict["Type2Avg_" + key] = pd.Series(np.float32(Type2_dict["Type2Avg_" + key] / 5))  # replace key (update)
-        Type3_dict["Type3Avg_" + key] = pd.Series(np.float32(Type3_dict["Type3Avg_" + key] / 5))  # replace key (update)
-
         print("%s, total frames %d, total avg %02.4f, Type1 avg %02.4f, Type2 avg %02.4f, Type3 avg %02.4f" %
-              (key, len_dict[key], Total_avg_dict["TotalAvg_" + key],
-               Type1_dict["Type1Avg_" + key], Type2_dict["Type2Avg_" + key], Type3_dict["Type3Avg_" + key]))
-
-    pd.DataFrame(Total_avg_dict).to_csv(total_csv_path, mode='a')
-    pd.DataFrame(Type1_dict).to_csv(total_csv_path, mode='a')
-    pd.DataFrame(Type2_dict).to_csv(total_csv_path, mode='a')
-    pd.DataFrame(Type3_dict).to_csv(total_csv_path, mode='a')
+              (key, len(summary[("TotalAvg", key)]), ffmetrics.mean(summary[("TotalAvg", key)]),
+               *[ffmetrics.mean(summary.get(("Type%dAvg" % t, key), [])) for t in (1, 2, 3)]))
 
     print("csv file of all metrics for all scenes has been saved in [%s]" %
           (total_csv_path))
@@ -622,7 +609,7 @@ def ssim_bgr(img_true, img_pred):  ##### SSIM for BGR, not RGB #####
     Y_true = _rgb2ycbcr(to_uint8(img_true, 0, 255)[:, :, ::-1], 255)[:, :, 0]
     Y_pred = _rgb2ycbcr(to_uint8(img_pred, 0, 255)[:, :, ::-1], 255)[:, :, 0]
     # return compare_ssim(Y_true, Y_pred, data_range=Y_pred.max() - Y_pred.min())
-    return structural_similarity(Y_true, Y_pred, data_range=Y_pred.max() - Y_pred.min())
+    return ffmetrics.ssim(Y_pred, Y_true)
 
 
 def im2tensor(image, imtype=np.uint8, cent=1., factor=255. / 2.):